@@ -1,24 +1,58 @@
-from quart import Quart, render_template, request, jsonify, websocket
+from quart import Quart, Response, render_template, request, jsonify, websocket
 from quart_cors import cors
 import socketio
 
 import ssl
 
 import time, json
-from util import callrpc
+import base64
+import struct
+from util import (
+    callrpc,
+    callrpc_batch,
+    callrpc_shared,
+    rpcStats,
+    rpcPriority,
+    RpcOverloaded,
+    TipCache,
+    SingleFlight,
+    rpcFlight,
+    PRIORITY_BROADCAST,
+    PRIORITY_BACKGROUND,
+)
 import asyncio
 import uvicorn
 
-from binascii import unhexlify
-
 import asyncio, random
 import queue
 import zmq
 
 from functools import wraps
-from database import Database, AsyncLvldb
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from database import (
+    Database,
+    AsyncLvldb,
+    addrTxSuffix,
+    parseAddrTxSuffix,
+    txBodyKey,
+    blockHashKey,
+    blockKey,
+    blockSummary,
+    encodeValue,
+)
+from enrich import Enricher
 
 from zmq_sub import ZMQHandler
+from pre_cache import PreCache
+from mempool import MempoolMirror
+from subscriptions import AddressSubscriptions, parseAddresses
+from emitter import Emitter
 
 PORT = 51725
 
@@ -26,6 +60,52 @@ CORS_ALLOWED_ORIGINS = "*"
 
 VERSION = "0.2"
 
+# Default and largest page of the cursor based history endpoint, and the
+# number of txs a history stream enriches at a time.
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+HISTORY_STREAM_WINDOW = 16
+
+# Blocks and height -> hash lookups more than this many blocks below the
+# tip are answered from LevelDB. The indexer keeps them in step with the
+# chain and removes them when it rolls a block back.
+BLOCK_CACHE_DEPTH = 6
+
+# Txs at least this deep are served from a stored response body.
+TX_BODY_DEPTH = 100
+
+# Largest number of txids accepted by /api/txs/.
+BULK_TX_MAX = 250
+
+# Addresses per getaddressutxos call when UTXOs are streamed.
+UTXO_STREAM_CHUNK = 20
+
+# Mempool txs are placed above every block in the history order, newest
+# first by the time they entered the mempool.
+MEMPOOL_HEIGHT = 0xFFFFFFFF
+
+
+def dumpJson(obj, default=None):
+    """Compact, key sorted JSON as bytes, the same output as jsonify."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(
+        obj, default=default, sort_keys=True, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        if self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            dumpJson(obj, default=self.default) + b"\n", mimetype=self.mimetype
+        )
+
 
 class QuartSIO:
     def __init__(self) -> None:
@@ -36,11 +116,13 @@ class QuartSIO:
         self._quart_app = cors(self._quart_app, allow_origin=CORS_ALLOWED_ORIGINS)
         self._quart_app.config["SECRET_KEY"] = "secret!"
         self._quart_app.config["JSON_SORT_KEYS"] = False
+        self._quart_app.json = FastJSONProvider(self._quart_app)
         self._sio_app = socketio.ASGIApp(self._sio, self._quart_app)
         self.route = self._quart_app.route
         self.on = self._sio.on
         self.enter_room = self._sio.enter_room
         self.leave_room = self._sio.leave_room
+        self.rooms = self._sio.rooms
         self.emit = self._sio.emit
 
     async def _run(self, host: str, port: int):
@@ -60,6 +142,22 @@ class QuartSIO:
 app = QuartSIO()
 lvldb = AsyncLvldb()
 db = Database()
+enricher = Enricher(lvldb, PORT)
+tip = TipCache(PORT)
+# Concurrent requests for the same uncached tx or the same inputs share one
+# fetch and enrichment.
+flight = SingleFlight()
+# Inside the server the cache and indexes follow the chain right up to the
+# tip; reorged blocks are rolled back from their undo records.
+preCache = PreCache(lvldb, minConfirmations=1)
+# Answers address mempool lookups while it is in sync with ghostd.
+mempoolMirror = MempoolMirror(PORT, lvldb)
+# Socket.IO sessions watching addresses for new mempool txs.
+subscriptions = AddressSubscriptions()
+# Batches Socket.IO events and holds back slow clients.
+emitter = Emitter(app._sio)
+# The ZMQHandler, created once the server has started.
+daemon = None
 
 
 def api_required(func):
@@ -79,6 +177,15 @@ async def after_request(response):
     return response
 
 
+@app._quart_app.errorhandler(RpcOverloaded)
+async def rpcOverloaded(e):
+    return (
+        jsonify({"error": "Server busy, try again shortly"}),
+        503,
+        {"Retry-After": "1"},
+    )
+
+
 @app.route("/", methods=["POST", "GET"])
 async def index():
     return await render_template("template.html", content=request.method)
@@ -91,78 +198,161 @@ async def ping():
 
 @app.route("/getblockcount/", methods=["GET"])
 async def getBlockCount():
-    return jsonify(await callrpc(PORT, "getblockcount"))
+    return jsonify(await tip.getHeight())
 
 
 @app.route("/getblockchaininfo/", methods=["GET"])
 async def getBlockChainInfo():
-    return jsonify(await callrpc(PORT, "getblockchaininfo"))
+    return jsonify(await tip.getChainInfo())
+
+
+@app.route("/api/stats/", methods=["GET"])
+async def getStats():
+    return jsonify(
+        {
+            "txCache": lvldb.cache.stats(),
+            "singleFlight": {"tx": flight.stats(), "rpc": rpcFlight.stats()},
+            "mempool": mempoolMirror.stats(),
+            "rpc": rpcStats(),
+            "zmq": daemon.stats() if daemon else None,
+            "subscriptions": subscriptions.stats(),
+            "emitter": emitter.stats(),
+        }
+    )
 
 
 @app.route("/api/block/<blockHash>/", methods=["GET"])
 async def getBlock(blockHash):
-    return jsonify(await callrpc(PORT, "getblock", [blockHash]))
+    tipHeight = await tip.getHeight()
+
+    block = await lvldb.getValue(blockKey(blockHash))
+    if block is not None and block["height"] <= tipHeight - BLOCK_CACHE_DEPTH:
+        nextHash = await lvldb.get(blockHashKey(block["height"] + 1))
+        if nextHash is not None:
+            block["confirmations"] = tipHeight - block["height"] + 1
+            block["nextblockhash"] = nextHash.decode("utf-8")
+            return jsonify(block)
+
+    block = await callrpc_shared(PORT, "getblock", [blockHash])
+    if block["confirmations"] > BLOCK_CACHE_DEPTH:
+        await lvldb.write(
+            [
+                (blockHashKey(block["height"]), bytes(block["hash"], "utf-8")),
+                (blockKey(block["hash"]), encodeValue(blockSummary(block))),
+            ]
+        )
+    return jsonify(block)
 
 
 @app.route("/api/block-index/<blockIndex>/", methods=["GET"])
 async def getBlockHash(blockIndex):
-    blockHash = {"blockHash": await callrpc(PORT, "getblockhash", [int(blockIndex)])}
+    height = int(blockIndex)
+    isDeep = height <= await tip.getHeight() - BLOCK_CACHE_DEPTH
+
+    cached = await lvldb.get(blockHashKey(height)) if isDeep else None
+    if cached is not None:
+        return jsonify({"blockHash": cached.decode("utf-8")})
+
+    blockHash = {"blockHash": await callrpc_shared(PORT, "getblockhash", [height])}
+    if isDeep:
+        await lvldb.put(blockHashKey(height), bytes(blockHash["blockHash"], "utf-8"))
     return jsonify(blockHash)
 
 
 @app.route("/api/tx/<txid>/", methods=["GET"])
 async def getTx(txid, standalone=False):
-    tx = await lvldb.get(bytes(txid, "utf-8"))
-    if tx:
-        tx = json.loads(tx)
-        isCache = True
+    currHeight = await tip.getHeight() + 1
+
+    if not standalone:
+        body = await lvldb.getRaw(txBodyKey(txid))
+        if body is not None:
+            return Response(renderTxBody(body, currHeight), mimetype="application/json")
+
+    tx = await loadTx(txid)
+    tx = formatTx(tx, currHeight)
+
+    if standalone:
+        return tx
+    if tx.get("confirmations", 0) >= TX_BODY_DEPTH:
+        await lvldb.put(txBodyKey(txid), encodeTxBody(tx))
+    return jsonify(tx)
+
+
+@app.route("/api/txs/", methods=["POST"])
+async def getTxs():
+    reqJson = json.loads(await request.get_data())
+
+    if "txids" in reqJson:
+        txids = reqJson["txids"]
+        if isinstance(txids, str):
+            txids = removeBlank(txids.split(","))
     else:
-        isCache = False
-        tx = await callrpc(PORT, "getrawtransaction", [txid, True])
+        return "Missing Transactions"
+
+    if len(txids) > BULK_TX_MAX:
+        return f"Too many transactions, at most {BULK_TX_MAX}", 400
+
+    currHeight = await tip.getHeight() + 1
+    cached = await lvldb.getValues([bytes(txid, "utf-8") for txid in txids])
+
+    missing = list(dict.fromkeys(txid for txid, tx in zip(txids, cached) if not tx))
+    fetched = await callrpc_batch(
+        PORT, [("getrawtransaction", [txid, True]) for txid in missing]
+    )
+    fetched = dict(zip(missing, fetched))
+
+    async def getItem(txid, tx):
+        try:
+            if not tx:
+                tx = await flight.do(("tx", txid), fetchTx, txid, fetched[txid])
+            return formatTx(tx, currHeight)
+        except Exception as e:
+            return {"txid": txid, "error": str(e)}
+
+    return jsonify(
+        await asyncio.gather(*[getItem(txid, tx) for txid, tx in zip(txids, cached)])
+    )
 
-        isCoinStake = True if unhexlify(tx["hex"])[1] == 0x02 else False
-        tx["isCoinStake"] = isCoinStake
-        if isCoinStake:
-            rewardDetails = await callrpc(PORT, "getblockreward", [int(tx["height"])])
 
-            tx["reward"] = float(rewardDetails["blockreward"])
-            tx["rewardSat"] = convertToSat(rewardDetails["blockreward"])
+# Stands in for the confirmations of a stored body while it is rendered, so
+# the position the current value goes to can be found.
+CONFIRMATIONS_MARK = "\x00confirmations\x00"
+CONFIRMATIONS_MARK_JSON = dumpJson(CONFIRMATIONS_MARK)
 
-            if "gvrreward" in rewardDetails and rewardDetails["blockreward"] > 0:
-                tx["isAGVR"] = True
-                tx["rewardAGVR"] = float(rewardDetails["gvrreward"])
-                tx["rewardAGVRSat"] = convertToSat(rewardDetails["gvrreward"])
-            else:
-                tx["isAGVR"] = False
 
-        tx["vin"] = await getInputDetails(tx["vin"], txid)
+def encodeTxBody(tx):
+    """The response body of a deep tx, stored as its height and the offset
+    of the confirmations value followed by the JSON without that value."""
+    body = dumpJson(dict(tx, confirmations=CONFIRMATIONS_MARK))
+    split = body.index(CONFIRMATIONS_MARK_JSON)
+    return (
+        struct.pack(">II", tx["height"], split)
+        + body[:split]
+        + body[split + len(CONFIRMATIONS_MARK_JSON) :]
+    )
 
+
+def renderTxBody(body, currHeight):
+    height, split = struct.unpack_from(">II", body)
+    return b"".join(
+        (body[8 : 8 + split], b"%d" % (currHeight - height), body[8 + split :], b"\n")
+    )
+
+
+def formatTx(tx, currHeight):
     if "time" not in tx:
         tx["time"] = int(time.time())
     if "confirmations" in tx:
-        currHeight = await callrpc(PORT, "getblockcount") + 1
         tx["confirmations"] = currHeight - tx["height"]
-    if not isCache:
-        if "confirmations" in tx and tx["confirmations"] >= 100:
-            if await db.getVinDetail(txid):
-                await db.removeVinDetail(txid)
-            await lvldb.put(
-                bytes(txid, "utf-8"), json.dumps(tx, indent=2).encode("utf-8")
-            )
 
     del tx["hex"]
-    if standalone:
-        return tx
-    return jsonify(tx)
+    return tx
 
 
 @app.route("/api/addrs/<addrs>/txs/", methods=["GET"])
 async def getTxHistory(addrs):
     addrs = removeBlank(addrs.split(","))
 
-    txids = await callrpc(PORT, "getaddresstxids", [{"addresses": addrs}])
-    txHistory = []
-
     fromIdx = 0
     toIdx = 10
 
@@ -172,17 +362,7 @@ async def getTxHistory(addrs):
     if request.args.get("to"):
         toIdx = int(request.args.get("to"))
 
-    mempool = await callrpc(PORT, "getaddressmempool", [{"addresses": addrs}])
-
-    if mempool:
-        memTxs = []
-        for mem in mempool:
-            if mem["txid"] not in memTxs:
-                memTxs.append(mem["txid"])
-
-        txids += memTxs
-
-    resp = await getAddrHist(txids, fromIdx, toIdx)
+    resp = await getAddrHist(addrs, fromIdx, toIdx)
 
     return jsonify(resp)
 
@@ -197,9 +377,6 @@ async def getTxHistoryPost():
     else:
         return "Missing Addresses"
 
-    txids = await callrpc(PORT, "getaddresstxids", [{"addresses": addrs}])
-    txHistory = []
-
     fromIdx = 0
     toIdx = 10
 
@@ -209,19 +386,55 @@ async def getTxHistoryPost():
     if "to" in reqJson:
         toIdx = int(reqJson["to"])
 
-    mempool = await callrpc(PORT, "getaddressmempool", [{"addresses": addrs}])
+    resp = await getAddrHist(addrs, fromIdx, toIdx)
 
-    if mempool:
-        memTxs = []
-        for mem in mempool:
-            if mem["txid"] not in memTxs:
-                memTxs.append(mem["txid"])
+    return jsonify(resp)
 
-        txids += memTxs
 
-    resp = await getAddrHist(txids, fromIdx, toIdx)
+@app.route("/api/addrs/<addrs>/history/", methods=["GET"])
+async def getHistory(addrs):
+    addrs = removeBlank(addrs.split(","))
 
-    return jsonify(resp)
+    return await historyResponse(
+        addrs,
+        request.args.get("cursor"),
+        request.args.get("limit", HISTORY_PAGE_SIZE),
+        request.args.get("stream") in ("1", "true"),
+    )
+
+
+@app.route("/api/addrs/history/", methods=["POST"])
+async def getHistoryPost():
+    reqJson = json.loads(await request.get_data())
+
+    if "addrs" in reqJson:
+        addrs = reqJson["addrs"]
+        addrs = removeBlank(addrs.split(","))
+    else:
+        return "Missing Addresses"
+
+    return await historyResponse(
+        addrs,
+        reqJson.get("cursor"),
+        reqJson.get("limit", HISTORY_PAGE_SIZE),
+        bool(reqJson.get("stream")),
+    )
+
+
+async def historyResponse(addrs, cursor, limit, stream):
+    try:
+        after = decodeCursor(cursor) if cursor else None
+    except ValueError:
+        return "Invalid cursor", 400
+
+    if stream:
+        return Response(streamAddrHist(addrs, after), mimetype="application/x-ndjson")
+
+    try:
+        limit = min(max(int(limit), 1), HISTORY_PAGE_MAX)
+    except ValueError:
+        return "Invalid limit", 400
+    return jsonify(await getAddrHistPage(addrs, after, limit))
 
 
 @app.route("/api/addr/<addr>/utxo/", methods=["GET"])
@@ -233,6 +446,7 @@ async def getUtxo(addr):
 
 @app.route("/api/tx/send/", methods=["POST"])
 async def sendTx():
+    rpcPriority.set(PRIORITY_BROADCAST)
     req = json.loads(await request.get_data())
 
     if "rawtx" not in req:
@@ -264,6 +478,11 @@ async def getUtxoMultiGet():
     else:
         return "Missing Addresses"
 
+    if reqJson.get("stream"):
+        return Response(
+            streamUTXOs(removeBlank(addrs.split(","))), mimetype="application/x-ndjson"
+        )
+
     utxo = await getUTXOs(addrs)
 
     return jsonify(sorted(utxo, key=lambda d: d["confirmations"]))
@@ -273,93 +492,184 @@ async def getUTXOs(addr):
 
     addr = removeBlank(addr.split(","))
 
-    currHeight = await callrpc(PORT, "getblockcount") + 1
-    utxo = await callrpc(PORT, "getaddressutxos", [{"addresses": addr}])
+    currHeight = await tip.getHeight() + 1
+    utxo, (spent, mempool) = await asyncio.gather(
+        callrpc_shared(PORT, "getaddressutxos", [{"addresses": addr}]),
+        getMempoolUTXOs(addr),
+    )
+
+    return confirmedUTXOs(utxo, spent, currHeight) + mempool
+
+
+async def getAddressMempool(addrs):
+    if mempoolMirror.current():
+        return mempoolMirror.getAddressMempool(addrs)
+    return await callrpc_shared(PORT, "getaddressmempool", [{"addresses": addrs}])
+
+
+async def getMempoolUTXOs(addrs):
+    """Outpoints spent by the mempool txs of addrs, and the outputs those
+    txs pay to addrs that are still unspent."""
+    mempool = await getAddressMempool(addrs)
+
+    spent = set()
+    received = []
+    for memUTXO in mempool or []:
+        if "prevtxid" in memUTXO:
+            spent.add((memUTXO["prevtxid"], memUTXO["prevout"]))
+        else:
+            received.append(memUTXO)
 
+    # Entries from the mempool mirror already carry their output script.
+    txids = list(
+        dict.fromkeys(
+            memUTXO["txid"] for memUTXO in received if "script" not in memUTXO
+        )
+    )
+    txs = await callrpc_batch(
+        PORT, [("getrawtransaction", [txid, True]) for txid in txids]
+    )
+    txs = dict(zip(txids, txs))
+
+    unspent = []
+    for memUTXO in received:
+        if (memUTXO["txid"], memUTXO["index"]) in spent:
+            continue
+        if "script" not in memUTXO:
+            tx = txs[memUTXO["txid"]]
+            # A tx that failed to load has left the mempool since it was listed.
+            if isinstance(tx, Exception):
+                continue
+            memUTXO["script"] = tx["vout"][memUTXO["index"]]["scriptPubKey"]["hex"]
+        memUTXO["outputIndex"] = memUTXO["index"]
+        memUTXO["confirmations"] = 0
+
+        del memUTXO["index"]
+        unspent.append(memUTXO)
+
+    return spent, unspent
+
+
+def confirmedUTXOs(utxo, spent, currHeight):
+    unspent = []
     for i in utxo:
+        if (i["txid"], i["outputIndex"]) in spent:
+            continue
         i["confirmations"] = currHeight - int(i["height"])
+        unspent.append(i)
+    return unspent
 
-    mempool = await callrpc(PORT, "getaddressmempool", [{"addresses": addr}])
 
+async def streamUTXOs(addrs):
+    currHeight = await tip.getHeight() + 1
+    spent, mempool = await getMempoolUTXOs(addrs)
     if mempool:
-        for memUTXO in mempool.copy():
-            if "prevtxid" in memUTXO:
-                for unspentTx in utxo.copy():
-                    if (
-                        unspentTx["txid"] == memUTXO["prevtxid"]
-                        and unspentTx["outputIndex"] == memUTXO["prevout"]
-                    ):
-                        utxo.remove(unspentTx)
-                mempool.remove(memUTXO)
+        yield ("\n".join(json.dumps(i) for i in mempool) + "\n").encode("utf-8")
 
-            else:
-                tx = await callrpc(PORT, "getrawtransaction", [memUTXO["txid"], True])
-                memUTXO["script"] = tx["vout"][memUTXO["index"]]["scriptPubKey"]["hex"]
-                memUTXO["outputIndex"] = memUTXO["index"]
-                memUTXO["confirmations"] = 0
+    chunks = [
+        addrs[i : i + UTXO_STREAM_CHUNK]
+        for i in range(0, len(addrs), UTXO_STREAM_CHUNK)
+    ]
 
-                del memUTXO["index"]
+    def fetchChunk(chunk):
+        return asyncio.ensure_future(
+            callrpc_shared(PORT, "getaddressutxos", [{"addresses": chunk}])
+        )
+
+    # The next chunk of addresses is queried while the current one is sent.
+    pending = fetchChunk(chunks[0]) if chunks else None
+    try:
+        for n in range(len(chunks)):
+            utxo = await pending
+            pending = fetchChunk(chunks[n + 1]) if n + 1 < len(chunks) else None
 
-        utxo = utxo + mempool
+            utxo = confirmedUTXOs(utxo, spent, currHeight)
+            utxo.sort(key=lambda d: d["confirmations"])
+            if utxo:
+                yield ("\n".join(json.dumps(i) for i in utxo) + "\n").encode("utf-8")
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def loadTx(txid, fetched=None):
+    tx = await lvldb.getValue(bytes(txid, "utf-8"))
+    if tx:
+        return tx
+    return await flight.do(("tx", txid), fetchTx, txid, fetched)
 
-    return utxo
+
+async def fetchTx(txid, fetched=None):
+    if isinstance(fetched, Exception):
+        raise fetched
+    if fetched is None:
+        fetched = await callrpc_shared(PORT, "getrawtransaction", [txid, True])
+    tx = fetched
+
+    await enricher.enrichCoinStake(tx)
+    tx["vin"] = await getInputDetails(tx["vin"], txid)
+
+    if "confirmations" in tx and tx["confirmations"] >= 100:
+        if await db.getVinDetail(txid):
+            await db.removeVinDetail(txid)
+        await lvldb.putValue(bytes(txid, "utf-8"), tx)
+    return tx
 
 
 async def getInputDetails(inputs, txid):
+    return await flight.do(("inputs", txid), _getInputDetails, inputs, txid)
+
+
+async def _getInputDetails(inputs, txid):
 
     existing = await db.getVinDetail(txid)
 
     if existing:
         return existing
 
-    for vin in inputs:
-        addr = None
-        amount = None
-        amountSats = None
+    inputs = await enricher.getInputDetails(inputs)
 
-        if "type" in vin and vin["type"] in ["anon", "blind"]:
-            vin["type"] = vin["type"]
-            vin["addr"] = addr
-            vin["value"] = amount
-            vin["valueSat"] = amountSats
-        else:
-            inTX = await lvldb.get(bytes(vin["txid"], "utf-8"))
-            if not inTX:
-                inTX = await callrpc(PORT, "getrawtransaction", [vin["txid"], True])
-            else:
-                inTX = json.loads(inTX)
-            txType = (
-                inTX["vout"][vin["vout"]]["type"]
-                if "type" in inTX["vout"][vin["vout"]]
-                else "standard"
-            )
+    await db.newVinDetail(txid, json.dumps(inputs), int(time.time()))
+    return inputs
 
-            if txType not in ["anon", "blind"]:
-                addr = inTX["vout"][vin["vout"]]["scriptPubKey"]["addresses"][0]
-                amount = inTX["vout"][vin["vout"]]["value"]
-                amountSats = inTX["vout"][vin["vout"]]["valueSat"]
 
-            vin["type"] = txType
-            vin["addr"] = addr
-            vin["value"] = amount
-            vin["valueSat"] = amountSats
+async def getAddrHist(addrs, fromIdx, toIdx):
+    currHeight = await tip.getHeight() + 1
+    indexHeight = await lvldb.getIndexHeight()
 
-    await db.newVinDetail(txid, json.dumps(inputs), int(time.time()))
-    return inputs
+    mempool = await getAddressMempool(addrs)
+    memTxs = list(dict.fromkeys(mem["txid"] for mem in mempool or []))
+    memTxs.reverse()
 
+    # Blocks below indexHeight are answered from the local address index;
+    # ghostd is only asked about the few recent blocks above it.
+    if indexHeight:
+        recentTxs = []
+        if indexHeight < currHeight:
+            recentTxs = await callrpc_shared(
+                PORT,
+                "getaddresstxids",
+                [{"addresses": addrs, "start": indexHeight, "end": currHeight - 1}],
+            )
+        indexedCount, exactCount = await lvldb.getAddrTxCount(addrs)
+    else:
+        recentTxs = await callrpc_shared(
+            PORT, "getaddresstxids", [{"addresses": addrs}]
+        )
+        indexedCount, exactCount = 0, True
+    recentTxs.reverse()
 
-async def getAddrHist(txids, fromIdx, toIdx):
-    txHistory = []
-    txids.reverse()
+    headTxids = memTxs + recentTxs
+    totalItems = len(headTxids) + indexedCount
 
     if fromIdx < 0:
         fromIdx = 0
 
-    if toIdx > len(txids):
-        toIdx = len(txids)
+    if toIdx > totalItems:
+        toIdx = totalItems
 
-    if fromIdx > len(txids):
-        fromIdx = len(txids) - 1
+    if fromIdx > totalItems:
+        fromIdx = totalItems - 1
 
     if (toIdx - fromIdx) > 50:
         toIdx = fromIdx + 50
@@ -367,61 +677,172 @@ async def getAddrHist(txids, fromIdx, toIdx):
     if fromIdx > toIdx:
         toIdx = fromIdx + 10
 
-    currHeight = await callrpc(PORT, "getblockcount") + 1
-    tasks = []
-
-    for txid in txids[fromIdx:toIdx]:
-        tasks.append(processTxHistoryItem(txid, currHeight))
+    pageTxids = headTxids[fromIdx:toIdx]
+    nextCursor = None
+    if toIdx > len(headTxids):
+        offset = max(fromIdx - len(headTxids), 0)
+        limit = toIdx - len(headTxids) - offset
+        suffixes = await lvldb.getAddrTxSuffixesAt(addrs, offset, limit)
+        pageTxids += [parseAddrTxSuffix(suffix)[2] for suffix in suffixes]
+        # Lets clients continue with the cursor based history API, which
+        # does not have to skip over every newer tx.
+        if suffixes and len(suffixes) == limit:
+            nextCursor = encodeCursor(suffixes[-1])
 
-    results = await asyncio.gather(*tasks)
+    results = await loadHistoryItems(pageTxids, currHeight)
 
     results = sorted(results, key=lambda a: a["confirmations"])
 
-    resp = {"totalItems": len(txids), "from": fromIdx, "to": toIdx, "items": results}
+    resp = {
+        "totalItems": totalItems,
+        "totalApproximate": not exactCount,
+        "from": fromIdx,
+        "to": toIdx,
+        "items": results,
+        "next": nextCursor,
+    }
 
     return resp
 
 
-async def processTxHistoryItem(txid, currHeight):
-    txHistory = []
-    tx = await lvldb.get(bytes(txid, "utf-8"))
-    if tx:
-        tx = json.loads(tx)
-        isCache = True
-    else:
-        isCache = False
-        tx = await callrpc(PORT, "getrawtransaction", [txid, True])
-
-    if "addr" not in tx["vin"][0]:
-        isCoinStake = True if unhexlify(tx["hex"])[1] == 0x02 else False
-        tx["isCoinStake"] = isCoinStake
-        if isCoinStake:
-            rewardDetails = await callrpc(PORT, "getblockreward", [int(tx["height"])])
-
-            tx["reward"] = float(rewardDetails["blockreward"])
-            tx["rewardSat"] = convertToSat(rewardDetails["blockreward"])
-
-            if "gvrreward" in rewardDetails and rewardDetails["blockreward"] > 0:
-                tx["isAGVR"] = True
-                tx["rewardAGVR"] = float(rewardDetails["gvrreward"])
-                tx["rewardAGVRSat"] = convertToSat(rewardDetails["gvrreward"])
-            else:
-                tx["isAGVR"] = False
-        detailedVin = await getInputDetails(tx["vin"], txid)
-        tx["vin"] = detailedVin
+async def loadHistoryItems(txids, currHeight, returnExceptions=False):
+    # A tx mined between the mempool and index lookups can be listed twice,
+    # so each txid is loaded once and its item copied for every listing.
+    unique = list(dict.fromkeys(txids))
+    cached = {}
+    missing = []
+    for txid in unique:
+        tx = await lvldb.getValue(bytes(txid, "utf-8"))
+        if tx:
+            cached[txid] = tx
+        else:
+            missing.append(txid)
+
+    fetched = await callrpc_batch(
+        PORT, [("getrawtransaction", [txid, True]) for txid in missing]
+    )
+    fetched = dict(zip(missing, fetched))
+
+    tasks = []
+
+    for txid in unique:
+        tasks.append(
+            processTxHistoryItem(
+                txid, currHeight, cached=cached.get(txid), fetched=fetched.get(txid)
+            )
+        )
+
+    items = dict(
+        zip(unique, await asyncio.gather(*tasks, return_exceptions=returnExceptions))
+    )
+    return [
+        items[txid] if isinstance(items[txid], Exception) else dict(items[txid])
+        for txid in txids
+    ]
+
+
+def encodeCursor(suffix):
+    return base64.urlsafe_b64encode(suffix).decode("ascii").rstrip("=")
+
+
+def decodeCursor(cursor):
+    try:
+        suffix = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if len(suffix) <= 8:
+        raise ValueError("Invalid cursor")
+    return suffix
+
+
+async def getHistoryHead(addrs):
+    """History positions of the mempool txs and of the confirmed txs that
+    are not in the address index yet, newest first."""
+    currHeight = await tip.getHeight() + 1
+    indexHeight = await lvldb.getIndexHeight()
+
+    head = set()
+    mempool = await getAddressMempool(addrs)
+    for mem in mempool or []:
+        head.add(addrTxSuffix(MEMPOOL_HEIGHT, mem["timestamp"], mem["txid"]))
+
+    if not indexHeight or indexHeight < currHeight:
+        params = {"addresses": addrs}
+        if indexHeight:
+            params.update({"start": indexHeight, "end": currHeight - 1})
+        deltas = await callrpc_shared(PORT, "getaddressdeltas", [params])
+        for delta in deltas:
+            head.add(addrTxSuffix(delta["height"], delta["blockindex"], delta["txid"]))
+
+    return currHeight, sorted(head)
+
+
+async def getHistorySuffixes(addrs, after, limit, head):
+    suffixes = [suffix for suffix in head if after is None or suffix > after][:limit]
+    if len(suffixes) < limit:
+        # Index entries that are also in the head sort before its last one,
+        # so continuing after it skips them.
+        indexAfter = suffixes[-1] if suffixes else after
+        suffixes += await lvldb.getAddrTxSuffixes(
+            addrs, indexAfter, limit - len(suffixes)
+        )
+    return suffixes
+
+
+async def getAddrHistPage(addrs, after, limit):
+    currHeight, head = await getHistoryHead(addrs)
+
+    suffixes = await getHistorySuffixes(addrs, after, limit + 1, head)
+    nextCursor = encodeCursor(suffixes[limit - 1]) if len(suffixes) > limit else None
+    suffixes = suffixes[:limit]
+
+    items = await loadHistoryItems(
+        [parseAddrTxSuffix(suffix)[2] for suffix in suffixes], currHeight
+    )
+
+    return {"items": items, "next": nextCursor}
+
+
+async def streamAddrHist(addrs, after):
+    currHeight, head = await getHistoryHead(addrs)
+
+    async def loadWindow(after):
+        suffixes = await getHistorySuffixes(addrs, after, HISTORY_STREAM_WINDOW, head)
+        txids = [parseAddrTxSuffix(suffix)[2] for suffix in suffixes]
+        txs = await loadHistoryItems(txids, currHeight, returnExceptions=True)
+        return suffixes, txs
+
+    # The next window is enriched while the current one is being sent.
+    window = asyncio.ensure_future(loadWindow(after))
+    try:
+        while True:
+            suffixes, txs = await window
+            if not suffixes:
+                break
+            window = asyncio.ensure_future(loadWindow(suffixes[-1]))
+
+            lines = []
+            for suffix, tx in zip(suffixes, txs):
+                item = {"cursor": encodeCursor(suffix)}
+                if isinstance(tx, Exception):
+                    item["error"] = str(tx)
+                else:
+                    item["tx"] = tx
+                lines.append(json.dumps(item))
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+    finally:
+        window.cancel()
+
+
+async def processTxHistoryItem(txid, currHeight, cached=None, fetched=None):
+    # loadTx can hand the same object to concurrent callers.
+    tx = dict(cached if cached is not None else await loadTx(txid, fetched))
 
     if "confirmations" in tx:
         tx["confirmations"] = currHeight - tx["height"]
     else:
         tx["confirmations"] = 0
 
-    if not isCache:
-        if "confirmations" in tx and tx["confirmations"] >= 100:
-            if await db.getVinDetail(txid):
-                await db.removeVinDetail(txid)
-            await lvldb.put(
-                bytes(txid, "utf-8"), json.dumps(tx, indent=2).encode("utf-8")
-            )
     del tx["hex"]
 
     return tx
@@ -437,16 +858,6 @@ def removeBlank(addrLst):
     return addrLst
 
 
-def convertFromSat(value):
-    sat_readable = value / 10**8
-    return sat_readable
-
-
-def convertToSat(value):
-    sat_readable = value * 10**8
-    return round(sat_readable)
-
-
 @app.on("my event")
 async def test_message(message):
     await app.emit("my response", {"data": message["data"]})
@@ -460,23 +871,29 @@ async def test_connect(sid, environ):
 
 @app.on("disconnect")
 async def test_disconnect(sid):
+    subscriptions.unsubscribe(sid)
     print("Client disconnected")
 
 
 @app.on("join")
 async def on_join(sid, data):
-    username = data["username"]
-    room = data["room"]
-    app.enter_room(sid, room)
+    # Joining with "addresses" (a list or a comma separated string) sends the
+    # session only the mempool txs touching those addresses, without joining
+    # the "tx" room that receives all of them.
+    if "room" in data:
+        await app.enter_room(sid, data["room"])
 
-    # await app.emit("server_response", f'{username} has entered the room. {room}', room=room, to=sid)
+    if "addresses" in data:
+        return {"addresses": subscriptions.subscribe(sid, parseAddresses(data["addresses"]))}
 
 
 @app.on("leave")
-async def on_leave(data):
-    username = data["username"]
-    room = data["room"]
-    app.leave_room(room)
+async def on_leave(sid, data):
+    if "room" in data:
+        await app.leave_room(sid, data["room"])
+
+    if "addresses" in data:
+        return {"addresses": subscriptions.unsubscribe(sid, parseAddresses(data["addresses"]))}
 
 
 @app.on("client_message")
@@ -490,10 +907,24 @@ async def newTx(msg):
 
 @app._quart_app.before_serving
 async def startup():
+    global daemon
     loop = asyncio.get_event_loop()
-    daemon = ZMQHandler(PORT, loop, app)
+    daemon = ZMQHandler(
+        PORT,
+        loop,
+        app,
+        lvldb,
+        onBlock=preCache.notify,
+        tip=tip,
+        mempool=mempoolMirror,
+        subscriptions=subscriptions,
+        emitter=emitter,
+    )
+    app._quart_app.add_background_task(mempoolMirror.run)
     app._quart_app.add_background_task(runDb)
+    app._quart_app.add_background_task(preCache.follow)
     app._quart_app.add_background_task(daemon.start)
+    app._quart_app.add_background_task(emitter.run)
     app._quart_app.add_background_task(vinDetailCleanup)
 
 
@@ -524,47 +955,29 @@ def requestUpnp():
 
 
 async def vinDetailCleanup():
+    rpcPriority.set(PRIORITY_BACKGROUND)
     while True:
         while not db.conn:
             await asyncio.sleep(0.1)
         vinDetail = await db.getAllVinDetail()
+        txs = await callrpc_batch(
+            PORT, [("getrawtransaction", [item[0], True]) for item in vinDetail]
+        )
 
-        for item in vinDetail:
-
-            tx = await callrpc(PORT, "getrawtransaction", [item[0], True])
+        for item, tx in zip(vinDetail, txs):
+            if isinstance(tx, Exception):
+                print(f"vinDetailCleanup {item[0]}: {tx}")
+                continue
 
             if "confirmations" in tx and tx["confirmations"] >= 100:
                 if not await lvldb.get(bytes(item[0], "utf-8")):
-                    currHeight = await callrpc(PORT, "getblockcount") + 1
-                    isCoinStake = True if unhexlify(tx["hex"])[1] == 0x02 else False
-                    tx["isCoinStake"] = isCoinStake
-                    if isCoinStake:
-                        rewardDetails = await callrpc(
-                            PORT, "getblockreward", [int(tx["height"])]
-                        )
-
-                        tx["reward"] = float(rewardDetails["blockreward"])
-                        tx["rewardSat"] = convertToSat(rewardDetails["blockreward"])
-
-                        if (
-                            "gvrreward" in rewardDetails
-                            and rewardDetails["blockreward"] > 0
-                        ):
-                            tx["isAGVR"] = True
-                            tx["rewardAGVR"] = float(rewardDetails["gvrreward"])
-                            tx["rewardAGVRSat"] = convertToSat(
-                                rewardDetails["gvrreward"]
-                            )
-                        else:
-                            tx["isAGVR"] = False
+                    currHeight = await tip.getHeight() + 1
+                    await enricher.enrichCoinStake(tx)
                     detailedVin = await getInputDetails(tx["vin"], item[0])
                     tx["vin"] = detailedVin
 
                     tx["confirmations"] = currHeight - tx["height"]
-                    await lvldb.put(
-                        bytes(item[0], "utf-8"),
-                        json.dumps(tx, indent=2).encode("utf-8"),
-                    )
+                    await lvldb.putValue(bytes(item[0], "utf-8"), tx)
 
                 await db.removeVinDetail(item[0])
 
@@ -1,11 +1,177 @@
 import aiosqlite
+import copy
 import json
+import os
 import time
 import random
+import zlib
 from datetime import datetime
 import asyncio
 import plyvel
 import concurrent.futures
+import collections
+import heapq
+import itertools
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+LVLDB_PATH = 'sheltrPointLVL.db'
+
+# Bumped whenever the pre-cacher starts writing a new kind of index, so an
+# existing database is walked again from the first block to fill it.
+INDEX_VERSION = 1
+INDEX_PREFIXES = [b"out:", b"ah:", b"ac:", b"undo:", b"bh:", b"blk:"]
+
+# Values written to LevelDB start with one header byte naming the codec.
+# Values written before the header existed are pretty-printed JSON and
+# therefore always start with '{'.
+CODEC_JSON = 0x01
+CODEC_MSGPACK = 0x02
+CODEC_ZLIB = 0x80
+
+# Memory budget of the decoded-object cache in front of AsyncLvldb. Decoded
+# objects take roughly this many times the size of their encoded value.
+LVLDB_CACHE_BYTES = int(float(os.environ.get('SHELTR_TX_CACHE_MB', 64)) * 1024 * 1024)
+DECODED_SIZE_FACTOR = 3
+
+# History counts of several addresses are computed exactly while their
+# stored counts add up to at most this many txs. Above it the stored counts
+# are summed, counting txs shared by the addresses more than once.
+ADDR_COUNT_EXACT_MAX = int(os.environ.get('SHELTR_ADDR_COUNT_EXACT_MAX', 1000))
+
+LVLDB_CODEC = os.environ.get('SHELTR_LVLDB_CODEC', 'msgpack' if msgpack else 'json')
+LVLDB_COMPRESS = os.environ.get('SHELTR_LVLDB_COMPRESS', '0') == '1'
+
+
+def encodeValue(obj, codec=None, compress=None):
+    codec = codec or LVLDB_CODEC
+    compress = LVLDB_COMPRESS if compress is None else compress
+
+    if codec == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack codec requested but msgpack is not installed')
+        header = CODEC_MSGPACK
+        body = msgpack.packb(obj, use_bin_type=True)
+    elif codec == 'json':
+        header = CODEC_JSON
+        body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    else:
+        raise ValueError(f'Unknown LevelDB codec: {codec}')
+
+    if compress:
+        header |= CODEC_ZLIB
+        body = zlib.compress(body)
+
+    return bytes((header,)) + body
+
+
+def decodeValue(data):
+    if data is None:
+        return None
+    if data[:1] == b'{':
+        return json.loads(data)
+
+    header = data[0]
+    body = data[1:]
+    if header & CODEC_ZLIB:
+        body = zlib.decompress(body)
+        header &= ~CODEC_ZLIB
+
+    if header == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError('Value is msgpack encoded but msgpack is not installed')
+        return msgpack.unpackb(body, raw=False)
+    if header == CODEC_JSON:
+        return json.loads(body)
+    raise ValueError(f'Unknown LevelDB value header: {data[0]:#x}')
+
+def outputKey(txid, n):
+    return bytes(f"out:{txid}:{n}", "utf-8")
+
+
+def outputDetails(vout):
+    txType = vout["type"] if "type" in vout else "standard"
+    addr = None
+    valueSat = None
+    if txType not in ["anon", "blind", "data"]:
+        addrs = vout["scriptPubKey"].get("addresses")
+        addr = addrs[0] if addrs else None
+        valueSat = vout.get("valueSat")
+    return {
+        "type": txType,
+        "addr": addr,
+        "value": valueSat / 10**8 if valueSat is not None else None,
+        "valueSat": valueSat,
+    }
+
+
+def txAddresses(tx):
+    addrs = []
+    for vin in tx['vin']:
+        if vin.get('addr') and vin['addr'] not in addrs:
+            addrs.append(vin['addr'])
+    for vout in tx['vout']:
+        for addr in vout.get('scriptPubKey', {}).get('addresses', []):
+            if addr not in addrs:
+                addrs.append(addr)
+    return addrs
+
+
+def addrTxPrefix(addr):
+    return bytes(f"ah:{addr}:", "utf-8")
+
+
+def addrTxSuffix(height, pos, txid):
+    # Height and position in the block are stored inverted so a forward
+    # scan of an address prefix yields its newest txs first.
+    return struct.pack(">II", 0xFFFFFFFF - height, 0xFFFFFFFF - pos) + bytes(txid, "utf-8")
+
+
+def parseAddrTxSuffix(suffix):
+    invHeight, invPos = struct.unpack_from(">II", suffix)
+    return 0xFFFFFFFF - invHeight, 0xFFFFFFFF - invPos, suffix[8:].decode("utf-8")
+
+
+def addrTxKey(addr, height, pos, txid):
+    return addrTxPrefix(addr) + addrTxSuffix(height, pos, txid)
+
+
+def addrCountKey(addr):
+    return bytes(f"ac:{addr}", "utf-8")
+
+
+def txBodyKey(txid):
+    return bytes(f"txb:{txid}", "utf-8")
+
+
+def blockHashKey(height):
+    return b"bh:" + struct.pack(">I", height)
+
+
+def blockKey(blockHash):
+    return bytes(f"blk:{blockHash}", "utf-8")
+
+
+def blockSummary(block):
+    # confirmations and nextblockhash change as the chain grows, so they
+    # are filled in when the summary is served.
+    summary = {k: v for k, v in block.items()
+               if k not in ("tx", "confirmations", "nextblockhash", "rewardDetails")}
+    summary["tx"] = [tx["txid"] if isinstance(tx, dict) else tx for tx in block["tx"]]
+    return summary
+
+
+def rewardKey(height):
+    return b"reward:" + struct.pack(">I", height)
+
+
+def undoKey(height):
+    return b"undo:" + struct.pack(">I", height)
+
 
 class Database:
     def __init__(self):
@@ -74,15 +240,330 @@ class Database:
                 await conn.commit()
 
 
+class ObjectCache:
+    """LRU of decoded LevelDB values bounded by their approximate size.
+
+    get() hands out a copy of the top-level dict or list, so callers can
+    add, replace and delete its keys freely; nested values are shared with
+    the cache and must be treated as read-only.
+
+    A LevelDB read that was queued before a write can still return the old
+    value, so reads go through beginRead/endRead: endRead tells whether the
+    key was discarded (or the cache cleared) while the read was in flight,
+    in which case its value must not be put back.
+    """
+    def __init__(self, maxBytes=LVLDB_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # key -> [reads in flight, generation], only while reads are in
+        # flight; clear() bumps epoch instead of every generation.
+        self.reads = {}
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return copy.copy(entry[0])
+
+    def put(self, key, obj, size):
+        if size > self.maxBytes:
+            return
+        self._remove(key)
+        self.entries[key] = (obj, size)
+        self.size += size
+        while self.size > self.maxBytes:
+            _, (_, evictedSize) = self.entries.popitem(last=False)
+            self.size -= evictedSize
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def discard(self, key):
+        self._remove(key)
+        read = self.reads.get(key)
+        if read is not None:
+            read[1] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.epoch += 1
+
+    def beginRead(self, key):
+        read = self.reads.setdefault(key, [0, 0])
+        read[0] += 1
+        return (self.epoch, read[1])
+
+    def endRead(self, key, token):
+        """Finish a read started with beginRead; True if its value may be cached."""
+        read = self.reads[key]
+        read[0] -= 1
+        current = token == (self.epoch, read[1])
+        if not read[0]:
+            del self.reads[key]
+        return current
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "maxBytes": self.maxBytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
 class AsyncLvldb:
-    def __init__(self):
-        self.lvldb = plyvel.DB('sheltrPointLVL.db', create_if_missing=True)
+    def __init__(self, path=LVLDB_PATH, cacheBytes=LVLDB_CACHE_BYTES):
+        self.lvldb = plyvel.DB(path, create_if_missing=True)
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.cache = ObjectCache(cacheBytes)
     
     async def get(self, key):
         return await asyncio.get_running_loop().run_in_executor(self.executor, self.lvldb.get, key)
 
     async def put(self, key, value):
+        self.cache.discard(key)
         return await asyncio.get_running_loop().run_in_executor(self.executor, self.lvldb.put, key, value)
 
+    async def getValue(self, key):
+        obj = self.cache.get(key)
+        if obj is not None:
+            return obj
+        token = self.cache.beginRead(key)
+        try:
+            data = await self.get(key)
+        finally:
+            current = self.cache.endRead(key, token)
+        if data is None:
+            return None
+        obj = decodeValue(data)
+        if current:
+            self.cache.put(key, obj, len(data) * DECODED_SIZE_FACTOR)
+        return copy.copy(obj)
+
+    def _getMany(self, keys):
+        return [self.lvldb.get(key) for key in keys]
+
+    async def getValues(self, keys):
+        """getValue for many keys, reading every uncached one in a single executor call."""
+        values = [self.cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, obj in zip(keys, values) if obj is None))
+        if not missing:
+            return values
+
+        loaded = {}
+        tokens = [self.cache.beginRead(key) for key in missing]
+        try:
+            datas = await asyncio.get_running_loop().run_in_executor(self.executor, self._getMany, missing)
+        finally:
+            current = [self.cache.endRead(key, token) for key, token in zip(missing, tokens)]
+        for key, data, cacheable in zip(missing, datas, current):
+            if data is not None:
+                loaded[key] = decodeValue(data)
+                if cacheable:
+                    self.cache.put(key, loaded[key], len(data) * DECODED_SIZE_FACTOR)
+
+        for i, key in enumerate(keys):
+            if values[i] is None and key in loaded:
+                values[i] = copy.copy(loaded[key])
+        return values
+
+    async def putValue(self, key, obj):
+        return await self.put(key, encodeValue(obj))
+
+    async def getRaw(self, key):
+        """get through the object cache, for raw values that are served as is."""
+        data = self.cache.get(key)
+        if data is None:
+            token = self.cache.beginRead(key)
+            try:
+                data = await self.get(key)
+            finally:
+                current = self.cache.endRead(key, token)
+            if data is not None and current:
+                self.cache.put(key, data, len(data))
+        return data
+
+    def _getOutputs(self, outpoints):
+        found = {}
+        for txid, n in outpoints:
+            value = self.lvldb.get(outputKey(txid, n))
+            if value is not None:
+                txType, addr, valueSat = decodeValue(value)
+                found[(txid, n)] = {
+                    "type": txType,
+                    "addr": addr,
+                    "value": valueSat / 10**8 if valueSat is not None else None,
+                    "valueSat": valueSat,
+                }
+        return found
+
+    async def getOutputs(self, outpoints):
+        """Look up (txid, vout) pairs in the output index.
+
+        Returns a dict keyed by outpoint holding type, addr, value and
+        valueSat; outpoints that are not indexed are left out.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._getOutputs, list(outpoints))
+
+    async def getIndexHeight(self):
+        """Height below which the output and address indexes are complete."""
+        indexVersion = await self.get(b"indexVersion")
+        if indexVersion is None or int(indexVersion) < INDEX_VERSION:
+            return 0
+        bestBlock = await self.get(b"bestBlock")
+        return int(bestBlock) if bestBlock else 0
+
+    def _deletePrefix(self, prefix):
+        with self.lvldb.write_batch() as wb:
+            for key in self.lvldb.iterator(prefix=prefix, include_value=False):
+                wb.delete(key)
+
+    async def deletePrefix(self, prefix):
+        self.cache.clear()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._deletePrefix, prefix)
+
+    def _addrTxSuffixes(self, addrs, after=None):
+        iterators = []
+        for addr in addrs:
+            prefix = addrTxPrefix(addr)
+            if after is None:
+                keys = self.lvldb.iterator(prefix=prefix, include_value=False)
+            else:
+                # The prefix ends in ':', so ';' bounds the scan to it.
+                keys = self.lvldb.iterator(start=prefix + after, stop=prefix[:-1] + b";",
+                                           include_start=False, include_value=False)
+            iterators.append(key[len(prefix):] for key in keys)
+
+        # A tx touching several of the addresses has the same suffix under
+        # each of them, so duplicates come out of the merge adjacent.
+        last = None
+        for suffix in heapq.merge(*iterators):
+            if suffix != last:
+                yield suffix
+            last = suffix
+
+    def _getAddrTxSuffixesAt(self, addrs, offset, limit):
+        if len(addrs) == 1:
+            # A single address needs no merge, so plyvel can skip to the
+            # offset without building any suffixes.
+            prefix = addrTxPrefix(addrs[0])
+            keys = self.lvldb.iterator(prefix=prefix, include_value=False)
+            return [key[len(prefix):] for key in itertools.islice(keys, offset, offset + limit)]
+        return list(itertools.islice(self._addrTxSuffixes(addrs), offset, offset + limit))
+
+    async def getAddrTxSuffixesAt(self, addrs, offset, limit):
+        """Index suffixes of the txs of addrs from position offset on, newest first.
+
+        Every newer key is still skipped over, so deep pages should use
+        getAddrTxSuffixes with a cursor instead.
+        """
+        if limit <= 0:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._getAddrTxSuffixesAt, addrs, offset, limit)
+
+    def _getAddrTxSuffixes(self, addrs, after, limit):
+        return list(itertools.islice(self._addrTxSuffixes(addrs, after), limit))
+
+    async def getAddrTxSuffixes(self, addrs, after=None, limit=50):
+        """Index suffixes of the txs of addrs that come after the suffix after, newest first."""
+        if limit <= 0:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._getAddrTxSuffixes, addrs, after, limit)
+
+    def _getAddrTxCount(self, addrs):
+        addrs = list(dict.fromkeys(addrs))
+        total = 0
+        for addr in addrs:
+            count = self.lvldb.get(addrCountKey(addr))
+            total += int(count) if count else 0
+        if len(addrs) == 1:
+            return total, True
+        # Stored counts cannot be added up exactly across addresses that
+        # share txs, so small histories are counted by a bounded scan.
+        if total > ADDR_COUNT_EXACT_MAX:
+            return total, False
+        return sum(1 for _ in self._addrTxSuffixes(addrs)), True
+
+    async def getAddrTxCount(self, addrs):
+        """Number of indexed txs of addrs, and whether that number is exact."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._getAddrTxCount, addrs)
+
+    def writeBatch(self):
+        return AsyncWriteBatch(self)
+
+    def _write(self, ops):
+        with self.lvldb.write_batch(transaction=True) as wb:
+            for key, value in ops:
+                if value is None:
+                    wb.delete(key)
+                else:
+                    wb.put(key, value)
+
+    async def write(self, ops):
+        for key, _ in ops:
+            self.cache.discard(key)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._write, ops)
+
+
+class AsyncWriteBatch:
+    """Puts and deletes collected in memory and applied to LevelDB atomically.
+
+    Used either directly (`await batch.write()`) or as an async context
+    manager, which writes the batch on a clean exit and discards it if the
+    block raised.
+    """
+    def __init__(self, lvldb):
+        self.lvldb = lvldb
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def putValue(self, key, obj):
+        self.ops.append((key, encodeValue(obj)))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+    def extend(self, other):
+        """Move the ops of another batch to the end of this one."""
+        self.ops.extend(other.ops)
+        other.ops = []
+
+    def putOutputs(self, tx):
+        for n, vout in enumerate(tx['vout']):
+            out = outputDetails(vout)
+            if out['type'] == 'data':
+                continue
+            self.putValue(outputKey(tx['txid'], n), [out['type'], out['addr'], out['valueSat']])
+
+    async def write(self):
+        ops, self.ops = self.ops, []
+        if ops:
+            await self.lvldb.write(ops)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.write()
+
 
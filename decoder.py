@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import struct
+
+# Particl/Ghost serialization of transactions and blocks, decoded into the
+# same shape as decoderawtransaction and getblock return. Scripts are not
+# disassembled, so scriptSig and scriptPubKey only carry their hex.
+
+PARTICL_TXN_VERSION = 0xA0
+
+TXN_STANDARD = 0
+TXN_COINBASE = 1
+TXN_COINSTAKE = 2
+
+OUTPUT_STANDARD = 1
+OUTPUT_CT = 2
+OUTPUT_RINGCT = 3
+OUTPUT_DATA = 4
+
+OUTPUT_TYPES = {
+    OUTPUT_STANDARD: "standard",
+    OUTPUT_CT: "blind",
+    OUTPUT_RINGCT: "anon",
+    OUTPUT_DATA: "data",
+}
+
+# prevout.n of an anon input; its prevout.hash holds the number of inputs
+# and the ring size instead of a txid.
+ANON_MARKER = 0xFFFFFFA0
+
+BLOCK_HEADER_SIZE = 112
+
+PUBKEY_ADDRESS = int(os.environ.get('SHELTR_PUBKEY_ADDRESS', 0x26))
+SCRIPT_ADDRESS = int(os.environ.get('SHELTR_SCRIPT_ADDRESS', 0x61))
+PUBKEY_ADDRESS_256 = int(os.environ.get('SHELTR_PUBKEY_ADDRESS_256', 0x39))
+SCRIPT_ADDRESS_256 = int(os.environ.get('SHELTR_SCRIPT_ADDRESS_256', 0x3d))
+
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_CHECKSIG = 0xac
+OP_HASH160 = 0xa9
+OP_SHA256 = 0xa8
+OP_IF = 0x63
+OP_ELSE = 0x67
+OP_ENDIF = 0x68
+OP_ISCOINSTAKE = 0xb8
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Reader:
+    """Cursor over a memoryview; reads return views into the same buffer."""
+    __slots__ = ('view', 'pos')
+
+    def __init__(self, data, pos=0):
+        self.view = data if isinstance(data, memoryview) else memoryview(data)
+        self.pos = pos
+
+    def read(self, n):
+        end = self.pos + n
+        if end > len(self.view):
+            raise DecodeError(f"Read of {n} bytes past the end at {self.pos}")
+        view = self.view[self.pos:end]
+        self.pos = end
+        return view
+
+    def unpack(self, fmt, size):
+        if self.pos + size > len(self.view):
+            raise DecodeError(f"Read of {size} bytes past the end at {self.pos}")
+        value = struct.unpack_from(fmt, self.view, self.pos)[0]
+        self.pos += size
+        return value
+
+    def uint8(self):
+        return self.unpack('<B', 1)
+
+    def uint32(self):
+        return self.unpack('<I', 4)
+
+    def int32(self):
+        return self.unpack('<i', 4)
+
+    def int64(self):
+        return self.unpack('<q', 8)
+
+    def compactSize(self):
+        size = self.uint8()
+        if size == 0xfd:
+            return self.unpack('<H', 2)
+        if size == 0xfe:
+            return self.unpack('<I', 4)
+        if size == 0xff:
+            return self.unpack('<Q', 8)
+        return size
+
+    def varBytes(self):
+        return self.read(self.compactSize())
+
+    def stack(self):
+        return [self.varBytes() for _ in range(self.compactSize())]
+
+
+def sha256d(*views):
+    h = hashlib.sha256()
+    for view in views:
+        h.update(view)
+    return hashlib.sha256(h.digest()).digest()
+
+
+def hashHex(view):
+    return bytes(view[::-1]).hex()
+
+
+def base58Check(version, payload):
+    data = bytes([version]) + bytes(payload)
+    data += sha256d(data)[:4]
+    n = int.from_bytes(data, 'big')
+    encoded = ''
+    while n:
+        n, r = divmod(n, 58)
+        encoded = B58_ALPHABET[r] + encoded
+    pad = len(data) - len(data.lstrip(b'\x00'))
+    return B58_ALPHABET[0] * pad + encoded
+
+
+def scriptAddress(script):
+    """Return (type, address) of a standard output script, address None if unknown."""
+    n = len(script)
+    if n == 25 and script[0] == OP_DUP and script[1] == OP_HASH160 and script[2] == 20 \
+            and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG:
+        return "pubkeyhash", base58Check(PUBKEY_ADDRESS, script[3:23])
+    if n == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+        return "scripthash", base58Check(SCRIPT_ADDRESS, script[2:22])
+    if n == 37 and script[0] == OP_DUP and script[1] == OP_SHA256 and script[2] == 32 \
+            and script[35] == OP_EQUALVERIFY and script[36] == OP_CHECKSIG:
+        return "pubkeyhash256", base58Check(PUBKEY_ADDRESS_256, script[3:35])
+    if n == 35 and script[0] == OP_SHA256 and script[1] == 32 and script[34] == OP_EQUAL:
+        return "scripthash256", base58Check(SCRIPT_ADDRESS_256, script[2:34])
+    if n > 4 and script[0] == OP_ISCOINSTAKE and script[1] == OP_IF and script[-1] == OP_ENDIF:
+        # Cold staking: the stake script is only used by coinstakes, the
+        # spend script after OP_ELSE owns the output.
+        for stakeLen in (25, 37):
+            if n > 3 + stakeLen and script[2 + stakeLen] == OP_ELSE:
+                spendType, addr = scriptAddress(script[3 + stakeLen:-1])
+                if addr is not None:
+                    return spendType, addr
+    if n and script[0] == 0x6a:
+        return "nulldata", None
+    return "nonstandard", None
+
+
+def scriptPubKey(script):
+    scriptType, addr = scriptAddress(script)
+    result = {"hex": script.hex(), "type": scriptType}
+    if addr is not None:
+        result['reqSigs'] = 1
+        result['addresses'] = [addr]
+    return result
+
+
+def readInput(reader, particl):
+    prevHash = reader.read(32)
+    n = reader.uint32()
+    scriptSig = reader.varBytes()
+    sequence = reader.uint32()
+
+    if particl and n == ANON_MARKER:
+        reader.stack()
+        nInputs, ringSize = struct.unpack_from('<II', prevHash)
+        return {"type": "anon", "num_inputs": nInputs, "ring_size": ringSize, "sequence": sequence}
+    if n == 0xFFFFFFFF and not any(prevHash):
+        return {"coinbase": scriptSig.hex(), "sequence": sequence}
+    return {
+        "txid": hashHex(prevHash),
+        "vout": n,
+        "scriptSig": {"hex": scriptSig.hex()},
+        "sequence": sequence,
+    }
+
+
+def readOutput(reader, outputType, n, skipped):
+    """Read one Particl output; rangeproof spans go into skipped, as they
+    are left out of the txid."""
+    vout = {"n": n, "type": OUTPUT_TYPES.get(outputType)}
+    if outputType == OUTPUT_STANDARD:
+        valueSat = reader.int64()
+        vout['value'] = valueSat / 10**8
+        vout['valueSat'] = valueSat
+        vout['scriptPubKey'] = scriptPubKey(reader.varBytes())
+    elif outputType == OUTPUT_CT:
+        vout['valueCommitment'] = reader.read(33).hex()
+        vout['data_hex'] = reader.varBytes().hex()
+        vout['scriptPubKey'] = scriptPubKey(reader.varBytes())
+        start = reader.pos
+        reader.varBytes()
+        skipped.append((start, reader.pos))
+    elif outputType == OUTPUT_RINGCT:
+        vout['pubkey'] = reader.read(33).hex()
+        vout['valueCommitment'] = reader.read(33).hex()
+        vout['data_hex'] = reader.varBytes().hex()
+        start = reader.pos
+        reader.varBytes()
+        skipped.append((start, reader.pos))
+    elif outputType == OUTPUT_DATA:
+        vout['data_hex'] = reader.varBytes().hex()
+    else:
+        raise DecodeError(f"Unknown output type {outputType}")
+    return vout
+
+
+def readParticlTx(reader):
+    view = reader.view
+    start = reader.pos
+    version = reader.uint8()
+    version |= reader.uint8() << 8
+    locktime = reader.uint32()
+
+    vin = [readInput(reader, True) for _ in range(reader.compactSize())]
+    skipped = []
+    vout = []
+    for n in range(reader.compactSize()):
+        vout.append(readOutput(reader, reader.uint8(), n, skipped))
+
+    witnessStart = reader.pos
+    for txIn in vin:
+        stack = reader.stack()
+        if stack:
+            txIn['txinwitness'] = [item.hex() for item in stack]
+
+    # The txid covers everything before the witness stacks, with each
+    # rangeproof serialized as an empty vector.
+    parts = []
+    pos = start
+    for skipStart, skipEnd in skipped:
+        parts += [view[pos:skipStart], b'\x00']
+        pos = skipEnd
+    parts.append(view[pos:witnessStart])
+
+    return {
+        "txid": sha256d(*parts)[::-1].hex(),
+        "hash": sha256d(view[start:reader.pos])[::-1].hex(),
+        "version": version,
+        "size": reader.pos - start,
+        "locktime": locktime,
+        "vin": vin,
+        "vout": vout,
+    }
+
+
+def readBitcoinTx(reader):
+    view = reader.view
+    start = reader.pos
+    version = reader.int32()
+
+    segwit = reader.view[reader.pos:reader.pos + 2] == b'\x00\x01'
+    if segwit:
+        reader.pos += 2
+    ioStart = reader.pos
+
+    vin = [readInput(reader, False) for _ in range(reader.compactSize())]
+    vout = []
+    for n in range(reader.compactSize()):
+        valueSat = reader.int64()
+        vout.append({
+            "value": valueSat / 10**8,
+            "valueSat": valueSat,
+            "n": n,
+            "scriptPubKey": scriptPubKey(reader.varBytes()),
+        })
+    ioEnd = reader.pos
+
+    if segwit:
+        for txIn in vin:
+            stack = reader.stack()
+            if stack:
+                txIn['txinwitness'] = [item.hex() for item in stack]
+    lockStart = reader.pos
+    locktime = reader.uint32()
+
+    return {
+        "txid": sha256d(view[start:start + 4], view[ioStart:ioEnd], view[lockStart:reader.pos])[::-1].hex(),
+        "hash": sha256d(view[start:reader.pos])[::-1].hex(),
+        "version": version,
+        "size": reader.pos - start,
+        "locktime": locktime,
+        "vin": vin,
+        "vout": vout,
+    }
+
+
+def readTx(reader):
+    if reader.pos >= len(reader.view):
+        raise DecodeError("Empty transaction")
+    if reader.view[reader.pos] >= PARTICL_TXN_VERSION:
+        return readParticlTx(reader)
+    return readBitcoinTx(reader)
+
+
+def decodeTx(data):
+    """Decode a serialized transaction, such as the body of a rawtx message."""
+    reader = Reader(data)
+    tx = readTx(reader)
+    if reader.pos != len(reader.view):
+        raise DecodeError(f"{len(reader.view) - reader.pos} trailing bytes after transaction")
+    return tx
+
+
+def isCoinStakeRaw(data):
+    return len(data) > 1 and data[0] >= PARTICL_TXN_VERSION and data[1] == TXN_COINSTAKE
+
+
+def decodeBlock(data, txDetails=True):
+    """Decode a serialized block, such as the body of a rawblock message.
+
+    With txDetails the tx list holds decoded transactions like getblock
+    with verbosity 2, otherwise only their txids.
+    """
+    reader = Reader(data)
+    header = reader.read(BLOCK_HEADER_SIZE)
+    version, = struct.unpack_from('<i', header, 0)
+    time_, bits, nonce = struct.unpack_from('<III', header, 100)
+
+    txs = []
+    for _ in range(reader.compactSize()):
+        tx = readTx(reader)
+        txs.append(tx if txDetails else tx['txid'])
+    blockSig = reader.varBytes()
+    if reader.pos != len(reader.view):
+        raise DecodeError(f"{len(reader.view) - reader.pos} trailing bytes after block")
+
+    return {
+        "hash": sha256d(header)[::-1].hex(),
+        "size": len(reader.view),
+        "version": version,
+        "merkleroot": hashHex(header[36:68]),
+        "witnessmerkleroot": hashHex(header[68:100]),
+        "time": time_,
+        "bits": f"{bits:08x}",
+        "nonce": nonce,
+        "previousblockhash": hashHex(header[4:36]),
+        "tx": txs,
+        "blocksig": blockSig.hex(),
+    }
+
+
+def txSummary(tx):
+    """The parts of a decoded tx the explorer relies on, to compare a local
+    decode with the one from ghostd."""
+    return (
+        tx['txid'],
+        [(vin.get('txid'), vin.get('vout'), vin.get('type'), 'coinbase' in vin) for vin in tx['vin']],
+        [(vout.get('type', "standard"), vout.get('valueSat'),
+          vout.get('scriptPubKey', {}).get('addresses')) for vout in tx['vout']],
+    )
+
+
+def compareBlock(raw, expected):
+    """Differences between the local decode of a raw block and ghostd's
+    getblock <hash> 2 output for it, as printable lines."""
+    block = decodeBlock(raw)
+    if block['hash'] != expected['hash'] or len(block['tx']) != len(expected['tx']):
+        return ["header or tx count mismatch"]
+
+    mismatches = []
+    for tx, rpcTx in zip(block['tx'], expected['tx']):
+        if txSummary(tx) != txSummary(rpcTx):
+            mismatches.append(f"Tx {rpcTx['txid']}: decode mismatch\n"
+                              f"  local: {txSummary(tx)}\n"
+                              f"  rpc:   {txSummary(rpcTx)}")
+        elif decodeTx(bytes.fromhex(rpcTx['hex']))['txid'] != rpcTx['txid']:
+            mismatches.append(f"Tx {rpcTx['txid']}: standalone decode mismatch")
+    return mismatches
+
+
+async def checkBlocks(port, start, count, capture=None):
+    """Compare count blocks from start with ghostd. With capture, each block
+    is also saved to that directory as a test vector: its raw hex next to
+    ghostd's getblock <hash> 2 output."""
+    # Imported here so the decoder itself has no dependency on the RPC layer.
+    from util import callrpc
+
+    checked = 0
+    mismatches = 0
+    for height in range(start, start + count):
+        blockHash = await callrpc(port, "getblockhash", [height])
+        rawHex = await callrpc(port, "getblock", [blockHash, 0])
+        expected = await callrpc(port, "getblock", [blockHash, 2])
+
+        if capture:
+            with open(os.path.join(capture, f"block-{height}.json"), 'w') as f:
+                json.dump({"hex": rawHex, "getblock": expected}, f, indent=1)
+                f.write('\n')
+
+        checked += len(expected['tx'])
+        for line in compareBlock(bytes.fromhex(rawHex), expected):
+            mismatches += 1
+            print(f"Block {height} {blockHash}: {line}")
+
+    print(f"Checked {checked} txs in {count} blocks, {mismatches} mismatches")
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode blocks from ghostd locally and compare them with its own decoding.")
+    parser.add_argument("--port", type=int, default=51725, help="ghostd RPC port (default: %(default)s)")
+    parser.add_argument("--start", type=int, required=True, help="first block height to check")
+    parser.add_argument("--count", type=int, default=100, help="number of blocks to check (default: %(default)s)")
+    parser.add_argument("--capture", metavar="DIR", help="also save the blocks to DIR as test vectors, e.g. tests/vectors")
+    args = parser.parse_args()
+
+    raise SystemExit(1 if asyncio.run(checkBlocks(args.port, args.start, args.count, args.capture)) else 0)
@@ -0,0 +1,163 @@
+import asyncio
+import os
+
+# Events for the same room or session emitted within this many seconds are
+# sent together. The default of 0 sends every event straight away, as
+# clients that predate batching only listen for single events.
+EMIT_WINDOW = float(os.environ.get('SHELTR_EMIT_WINDOW', 0))
+
+# Packets a client may have waiting to be written before it is skipped;
+# 0 disables the check.
+EMIT_CLIENT_QUEUE_LIMIT = int(os.environ.get('SHELTR_EMIT_CLIENT_QUEUE_LIMIT', 100))
+
+# How often latest-only events held back for slow clients are retried.
+EMIT_RETRY_INTERVAL = 1.0
+
+NAMESPACE = '/'
+
+
+def batchEvent(event):
+    """Name of the event carrying a list of several `event` payloads."""
+    return f"{event}s"
+
+
+class Emitter:
+    """Socket.IO delivery for the ZMQ handler.
+
+    Events are queued per room or session for EMIT_WINDOW seconds and then
+    sent as one message: a single event as itself, several events of the
+    same name as a list under batchEvent(name). Of events emitted with
+    latest=True only the newest one per room is kept.
+
+    Clients whose outgoing engine.io queue already holds
+    EMIT_CLIENT_QUEUE_LIMIT packets are skipped. They miss ordinary events,
+    but the newest latest=True event is held for them and sent once their
+    queue has drained.
+    """
+    def __init__(self, sio, window=EMIT_WINDOW, clientQueueLimit=EMIT_CLIENT_QUEUE_LIMIT):
+        self.sio = sio
+        self.window = window
+        self.clientQueueLimit = clientQueueLimit
+        # (room, to) -> [(event, data, latest)] waiting for the window to end.
+        self.pending = {}
+        # sid -> (event, data) held back while the client was lagging.
+        self.held = {}
+        self.counters = {
+            "events": 0,
+            "messages": 0,
+            "coalesced": 0,
+            "collapsed": 0,
+            "dropped": 0,
+            "held": 0,
+            "lagCheckErrors": 0,
+        }
+
+    def rooms(self, sid):
+        return self.sio.rooms(sid, namespace=NAMESPACE)
+
+    async def emit(self, event, data, room=None, to=None, latest=False):
+        self.counters['events'] += 1
+        target = (room, to)
+        if self.window <= 0:
+            await self.send(target, [(event, data, latest)])
+            return
+
+        if target not in self.pending:
+            self.pending[target] = []
+            asyncio.get_running_loop().call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush(target)))
+        self.pending[target].append((event, data, latest))
+
+    async def flush(self, target):
+        events = self.pending.pop(target, None)
+        if events:
+            try:
+                await self.send(target, events)
+            except Exception as e:
+                print(f"Emit to {target} failed: {e}")
+
+    async def send(self, target, events):
+        room, to = target
+
+        # Only the newest latest-only event of each name is worth sending.
+        newest = {}
+        for i, (event, _, latest) in enumerate(events):
+            if latest:
+                newest[event] = i
+        collapsed = [item for i, item in enumerate(events) if not item[2] or newest[item[0]] == i]
+        self.counters['collapsed'] += len(events) - len(collapsed)
+
+        laggards = self.laggards(to if to is not None else room)
+        for sid in laggards:
+            for event, data, latest in collapsed:
+                if latest:
+                    if sid in self.held:
+                        self.counters['collapsed'] += 1
+                    self.held[sid] = (event, data)
+                    self.counters['held'] += 1
+                else:
+                    self.counters['dropped'] += 1
+        if to is not None and laggards:
+            return
+
+        byEvent = {}
+        for event, data, _ in collapsed:
+            byEvent.setdefault(event, []).append(data)
+        for event, payloads in byEvent.items():
+            if len(payloads) == 1:
+                await self.sio.emit(event, payloads[0], room=room, to=to, skip_sid=laggards or None)
+            else:
+                await self.sio.emit(batchEvent(event), payloads, room=room, to=to, skip_sid=laggards or None)
+                self.counters['coalesced'] += len(payloads) - 1
+            self.counters['messages'] += 1
+
+    # Client queues are read from python-socketio and python-engineio
+    # internals (checked against the versions in requirements.txt). If they
+    # change, lookups fail and every client is treated as keeping up.
+
+    def internalsFailed(self, e):
+        if not self.counters['lagCheckErrors']:
+            print(f"Socket.IO client queues cannot be read, not skipping slow clients: {e!r}")
+        self.counters['lagCheckErrors'] += 1
+
+    def backlog(self, eioSid):
+        socket = self.sio.eio.sockets.get(eioSid)
+        return socket.queue.qsize() if socket is not None else 0
+
+    def laggards(self, room):
+        """Sessions in room (or the session itself) with a full outgoing queue."""
+        if self.clientQueueLimit <= 0 or room is None:
+            return []
+        try:
+            return [sid for sid, eioSid in self.sio.manager.get_participants(NAMESPACE, room)
+                    if self.backlog(eioSid) >= self.clientQueueLimit]
+        except Exception as e:
+            self.internalsFailed(e)
+            return []
+
+    def sessionBacklog(self, sid):
+        """Packets waiting for sid, None once it has disconnected."""
+        try:
+            eioSid = self.sio.manager.eio_sid_from_sid(sid, NAMESPACE)
+            return None if eioSid is None else self.backlog(eioSid)
+        except Exception as e:
+            self.internalsFailed(e)
+            return 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(EMIT_RETRY_INTERVAL)
+            for sid, (event, data) in list(self.held.items()):
+                backlog = self.sessionBacklog(sid)
+                if backlog is None:
+                    del self.held[sid]
+                elif backlog < self.clientQueueLimit:
+                    del self.held[sid]
+                    try:
+                        await self.sio.emit(event, data, to=sid)
+                        self.counters['messages'] += 1
+                    except Exception as e:
+                        print(f"Emit to {sid} failed: {e}")
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.pending), holding=len(self.held))
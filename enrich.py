@@ -0,0 +1,186 @@
+import asyncio
+
+from util import callrpc_batch, callrpc_shared
+from database import outputDetails, rewardKey
+
+# Heights whose block rewards are fetched together in one batched RPC when
+# the pre-cacher prefetches them.
+REWARD_PREFETCH_CHUNK = 500
+
+# Rewards looked up outside the indexer are only persisted once the block is
+# this deep; the indexer persists its own together with each block.
+REWARD_CACHE_DEPTH = 100
+
+
+def isCoinStake(tx):
+    # The second byte of a Ghost transaction is its type and 0x02 marks a
+    # coinstake, so only those two hex digits need to be looked at.
+    return tx['hex'][2:4] == "02"
+
+
+def convertFromSat(value):
+    sat_readable = value / 10**8
+    return sat_readable
+
+
+def convertToSat(value):
+    sat_readable = value * 10**8
+    return round(sat_readable)
+
+
+def rewardSummary(rewardDetails):
+    return {k: rewardDetails[k] for k in ("blockreward", "gvrreward") if k in rewardDetails}
+
+
+def applyReward(tx, rewardDetails):
+    tx['reward'] = float(rewardDetails['blockreward'])
+    tx['rewardSat'] = convertToSat(rewardDetails['blockreward'])
+
+    if "gvrreward" in rewardDetails and rewardDetails['blockreward'] > 0:
+        tx['isAGVR'] = True
+        tx['rewardAGVR'] = float(rewardDetails['gvrreward'])
+        tx['rewardAGVRSat'] = convertToSat(rewardDetails['gvrreward'])
+    else:
+        tx['isAGVR'] = False
+
+
+class Enricher:
+    """Coinstake reward and input enrichment shared by the API, the
+    pre-cacher and the ZMQ handler.
+
+    Block rewards are kept in LevelDB under reward:<height>, and the indexer
+    deletes the entry when it rolls a block back. lvldb may be None, in
+    which case everything is resolved over RPC.
+    """
+    def __init__(self, lvldb, rpcPort):
+        self.lvldb = lvldb
+        self.rpcPort = rpcPort
+        # Prefetch batches in flight by height, and their results waiting to
+        # be picked up by getBlockReward.
+        self.pendingRewards = {}
+        self.prefetched = {}
+
+    async def _fetchRewards(self, heights):
+        results = await callrpc_batch(self.rpcPort, [("getblockreward", [height]) for height in heights])
+        for height, rewardDetails in zip(heights, results):
+            if not isinstance(rewardDetails, Exception):
+                self.prefetched[height] = rewardSummary(rewardDetails)
+
+    def prefetchRewards(self, heights):
+        heights = [height for height in heights
+                   if height not in self.pendingRewards and height not in self.prefetched]
+        for i in range(0, len(heights), REWARD_PREFETCH_CHUNK):
+            chunk = heights[i:i + REWARD_PREFETCH_CHUNK]
+            future = asyncio.ensure_future(self._fetchRewards(chunk))
+            for height in chunk:
+                self.pendingRewards[height] = future
+            future.add_done_callback(lambda f, chunk=chunk: self._prefetchDone(f, chunk))
+
+    def _prefetchDone(self, future, chunk):
+        for height in chunk:
+            if self.pendingRewards.get(height) is future:
+                del self.pendingRewards[height]
+        if not future.cancelled() and future.exception():
+            print(f"Reward prefetch failed: {future.exception()}")
+
+    def clearPrefetched(self):
+        self.prefetched = {}
+
+    async def getBlockReward(self, height, persist=False):
+        future = self.pendingRewards.get(height)
+        if future is not None:
+            try:
+                await asyncio.shield(future)
+            except Exception:
+                pass
+        if height in self.prefetched:
+            return self.prefetched.pop(height)
+
+        if self.lvldb:
+            rewardDetails = await self.lvldb.getValue(rewardKey(height))
+            if rewardDetails is not None:
+                return rewardDetails
+
+        rewardDetails = rewardSummary(await callrpc_shared(self.rpcPort, "getblockreward", [height]))
+        if persist and self.lvldb:
+            await self.lvldb.putValue(rewardKey(height), rewardDetails)
+        return rewardDetails
+
+    async def enrichCoinStake(self, tx, height=None, rewardDetails=None):
+        tx['isCoinStake'] = isCoinStake(tx)
+        if tx['isCoinStake']:
+            if rewardDetails is None:
+                rewardDetails = await self.getBlockReward(
+                    int(height if height is not None else tx['height']),
+                    persist=tx.get('confirmations', 0) >= REWARD_CACHE_DEPTH)
+            applyReward(tx, rewardDetails)
+        return tx
+
+    async def getPrevOutputs(self, inputs):
+        outpoints = set()
+        for vin in inputs:
+            if "type" in vin and vin['type'] in ['anon', 'blind']:
+                continue
+            if "txid" in vin:
+                outpoints.add((vin['txid'], vin['vout']))
+
+        prevOuts = await self.lvldb.getOutputs(outpoints) if self.lvldb else {}
+
+        # Outputs that are not indexed yet are read from the cached or fetched
+        # previous transaction instead.
+        missing = {}
+        for prevTxid, n in outpoints:
+            if (prevTxid, n) not in prevOuts:
+                missing.setdefault(prevTxid, []).append(n)
+
+        prevTxs = {}
+        rpcTxids = []
+        for prevTxid in missing:
+            inTX = await self.lvldb.getValue(bytes(prevTxid, "utf-8")) if self.lvldb else None
+            if inTX:
+                prevTxs[prevTxid] = inTX
+            else:
+                rpcTxids.append(prevTxid)
+
+        results = await callrpc_batch(self.rpcPort, [("getrawtransaction", [prevTxid, True]) for prevTxid in rpcTxids])
+        for prevTxid, inTX in zip(rpcTxids, results):
+            if isinstance(inTX, Exception):
+                raise inTX
+            prevTxs[prevTxid] = inTX
+
+        for prevTxid, outputs in missing.items():
+            for n in outputs:
+                prevOuts[(prevTxid, n)] = outputDetails(prevTxs[prevTxid]['vout'][n])
+
+        return prevOuts
+
+    async def getInputDetails(self, inputs, prevOuts=None):
+
+        if prevOuts is None:
+            prevOuts = await self.getPrevOutputs(inputs)
+
+        for vin in inputs:
+            addr = None
+            amount = None
+            amountSats = None
+
+            if "type" in vin and vin['type'] in ['anon', 'blind']:
+                vin['type'] = vin['type']
+                vin['addr'] = addr
+                vin['value'] = amount
+                vin['valueSat'] = amountSats
+            else:
+                prevOut = prevOuts[(vin['txid'], vin['vout'])]
+                txType = prevOut['type']
+
+                if txType not in ['anon', 'blind']:
+                    addr = prevOut['addr']
+                    amount = prevOut['value']
+                    amountSats = prevOut['valueSat']
+
+                vin['type'] = txType
+                vin['addr'] = addr
+                vin['value'] = amount
+                vin['valueSat'] = amountSats
+
+        return inputs
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+
+from util import callrpc, callrpc_batch, rpcPriority, PRIORITY_TIP, RPC_BATCH_SIZE
+from database import outputDetails
+from enrich import Enricher
+
+# Seconds without a sequence message after which the mirror is no longer
+# trusted. ghostd sends at least a C event per block.
+MEMPOOL_TTL = float(os.environ.get('SHELTR_MEMPOOL_TTL', 300))
+
+
+class MempoolMirror:
+    """In-memory copy of ghostd's mempool, indexed by address.
+
+    Kept up to date from the ZMQ sequence topic: A and R events add and
+    remove single txs, and C events drop the txs of a connected block, for
+    which ghostd sends no R. Txs of a disconnected block come back as A
+    events. Whenever a sequence message is missed, and on startup, the
+    mirror is rebuilt from getrawmempool. Readers are expected to fall
+    back to getaddressmempool unless current(): the mirror has been
+    rebuilt, and a sequence message has arrived within the last ttl
+    seconds, so ghostd is publishing the topic and the socket delivers it.
+    """
+    def __init__(self, rpcPort, lvldb=None, ttl=MEMPOOL_TTL):
+        self.rpcPort = rpcPort
+        self.enricher = Enricher(lvldb, rpcPort)
+        self.ttl = ttl
+        self.events = asyncio.Queue()
+        self.lastSeq = None
+        self.lastMessage = None
+        self.synced = False
+        self.resyncs = 0
+        self.skipped = 0
+        # txid -> getaddressmempool style entries of that tx.
+        self.txs = {}
+        # address -> {txid: None}, in the order the txs were added.
+        self.addrTxs = {}
+
+    def onSequence(self, body, seq):
+        """Queue a raw sequence message; seq is the ZMQ message sequence number."""
+        if self.lastSeq is not None and seq != (self.lastSeq + 1) & 0xFFFFFFFF:
+            print(f"Mempool sequence gap {self.lastSeq} -> {seq}, resyncing")
+            self.events.put_nowait(('resync', None))
+        self.lastSeq = seq
+        self.lastMessage = time.monotonic()
+
+        label = body[32:33].decode('ascii')
+        if label in ('A', 'R', 'C'):
+            self.events.put_nowait((label, body[:32].hex()))
+
+    def current(self):
+        return (self.synced and self.lastMessage is not None
+                and time.monotonic() - self.lastMessage <= self.ttl)
+
+    def getAddressMempool(self, addrs):
+        addrs = set(addrs)
+        txids = {}
+        for addr in addrs:
+            txids.update(self.addrTxs.get(addr, {}))
+        entries = [dict(entry) for txid in txids for entry in self.txs[txid] if entry['address'] in addrs]
+        entries.sort(key=lambda entry: entry['timestamp'])
+        return entries
+
+    async def run(self):
+        rpcPriority.set(PRIORITY_TIP)
+        self.events.put_nowait(('resync', None))
+        while True:
+            events = [await self.events.get()]
+            while not self.events.empty():
+                events.append(self.events.get_nowait())
+            try:
+                await self.apply(events)
+            except Exception as e:
+                print(f"Mempool mirror error: {e}")
+                self.synced = False
+                self.events.put_nowait(('resync', None))
+                await asyncio.sleep(5)
+
+    async def apply(self, events):
+        if any(label == 'resync' for label, _ in events):
+            # A resync makes every event queued before it irrelevant.
+            last = max(i for i, (label, _) in enumerate(events) if label == 'resync')
+            await self.resync()
+            events = events[last + 1:]
+
+        added = []
+        for label, txid in events:
+            if label == 'A':
+                added.append(txid)
+                continue
+            if added:
+                await self.addTxs(added)
+                added = []
+            if label == 'R':
+                self.removeTx(txid)
+            elif label == 'C':
+                block = await callrpc(self.rpcPort, "getblock", [txid, 1])
+                for blockTxid in block['tx']:
+                    self.removeTx(blockTxid)
+        if added:
+            await self.addTxs(added)
+
+    async def resync(self):
+        self.synced = False
+        txids = set(await callrpc(self.rpcPort, "getrawmempool", []))
+        for txid in [txid for txid in self.txs if txid not in txids]:
+            self.removeTx(txid)
+        await self.addTxs([txid for txid in txids if txid not in self.txs])
+        self.synced = True
+        self.resyncs += 1
+        print(f"Mempool mirror synced with {len(self.txs)} txs")
+
+    async def addTxs(self, txids):
+        txids = [txid for txid in dict.fromkeys(txids) if txid not in self.txs]
+        for i in range(0, len(txids), RPC_BATCH_SIZE):
+            chunk = txids[i:i + RPC_BATCH_SIZE]
+            results = await callrpc_batch(self.rpcPort, [("getrawtransaction", [txid, True]) for txid in chunk])
+            # A tx that failed to load has already left the mempool again.
+            txs = [tx for tx in results if not isinstance(tx, Exception)]
+
+            try:
+                prevOuts = await self.enricher.getPrevOutputs([vin for tx in txs for vin in tx['vin']])
+            except ValueError:
+                # Some parent could not be loaded; find which tx it belongs to.
+                for tx in txs:
+                    await self.addTxAlone(tx)
+                continue
+            for tx in txs:
+                self.addTx(tx, prevOuts)
+
+    async def addTxAlone(self, tx):
+        try:
+            prevOuts = await self.enricher.getPrevOutputs(tx['vin'])
+        except ValueError as e:
+            # ghostd answered, but a parent is gone: it was replaced or
+            # evicted, and the tx will follow it out of the mempool.
+            if not str(e).startswith('RPC error'):
+                raise
+            print(f"Mempool tx {tx['txid']} skipped: {e}")
+            self.skipped += 1
+            return
+        self.addTx(tx, prevOuts)
+
+    def addTx(self, tx, prevOuts):
+        txid = tx['txid']
+        timestamp = int(time.time())
+        entries = []
+
+        for n, vout in enumerate(tx['vout']):
+            details = outputDetails(vout)
+            if details['addr'] is None:
+                continue
+            entries.append({
+                "address": details['addr'],
+                "txid": txid,
+                "index": n,
+                "satoshis": details['valueSat'] or 0,
+                "timestamp": timestamp,
+                "script": vout['scriptPubKey']['hex'],
+            })
+
+        for i, vin in enumerate(tx['vin']):
+            prevOut = prevOuts.get((vin.get('txid'), vin.get('vout')))
+            if prevOut is None or prevOut['addr'] is None:
+                continue
+            entries.append({
+                "address": prevOut['addr'],
+                "txid": txid,
+                "index": i,
+                "satoshis": -(prevOut['valueSat'] or 0),
+                "timestamp": timestamp,
+                "prevtxid": vin['txid'],
+                "prevout": vin['vout'],
+            })
+
+        self.txs[txid] = entries
+        for entry in entries:
+            self.addrTxs.setdefault(entry['address'], {})[txid] = None
+
+    def removeTx(self, txid):
+        entries = self.txs.pop(txid, None)
+        if entries is None:
+            return
+        for entry in entries:
+            txids = self.addrTxs.get(entry['address'])
+            if txids is not None:
+                txids.pop(txid, None)
+                if not txids:
+                    del self.addrTxs[entry['address']]
+
+    def stats(self):
+        return {
+            "synced": self.synced,
+            "current": self.current(),
+            "txs": len(self.txs),
+            "addresses": len(self.addrTxs),
+            "resyncs": self.resyncs,
+            "skipped": self.skipped,
+            "queued": self.events.qsize(),
+        }
@@ -0,0 +1,63 @@
+import argparse
+import json
+import time
+
+import plyvel
+
+from database import LVLDB_PATH, LVLDB_CODEC, LVLDB_COMPRESS, encodeValue
+
+
+def migrate(path, codec, compress, batchSize):
+    lvldb = plyvel.DB(path)
+    start = time.time()
+    migrated = 0
+    skipped = 0
+    sizeBefore = 0
+    sizeAfter = 0
+
+    # The iterator reads from an implicit snapshot, so rewriting values
+    # while iterating is safe.
+    wb = lvldb.write_batch()
+    for key, value in lvldb.iterator():
+        if not value.startswith(b'{'):
+            skipped += 1
+            continue
+        try:
+            obj = json.loads(value)
+        except ValueError:
+            skipped += 1
+            continue
+
+        encoded = encodeValue(obj, codec=codec, compress=compress)
+        wb.put(key, encoded)
+        migrated += 1
+        sizeBefore += len(value)
+        sizeAfter += len(encoded)
+
+        if migrated % batchSize == 0:
+            wb.write()
+            wb = lvldb.write_batch()
+            print(f"{migrated} values migrated in {time.time() - start:.1f} seconds")
+    wb.write()
+
+    print("Compacting database...")
+    lvldb.compact_range()
+    lvldb.close()
+
+    print(f"Migrated {migrated} values, skipped {skipped} in {time.time() - start:.1f} seconds")
+    if sizeBefore:
+        print(f"Value bytes {sizeBefore} -> {sizeAfter} ({100 * sizeAfter / sizeBefore:.1f}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rewrite legacy JSON values in the LevelDB cache with the compact codec.")
+    parser.add_argument("--path", default=LVLDB_PATH, help="LevelDB directory (default: %(default)s)")
+    parser.add_argument("--codec", default=LVLDB_CODEC, choices=["msgpack", "json"],
+                        help="value codec (default: %(default)s)")
+    parser.add_argument("--compress", action="store_true", default=LVLDB_COMPRESS,
+                        help="zlib-compress values")
+    parser.add_argument("--batch-size", type=int, default=10_000,
+                        help="values written per LevelDB batch (default: %(default)s)")
+    args = parser.parse_args()
+
+    migrate(args.path, args.codec, args.compress, args.batch_size)
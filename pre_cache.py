@@ -1,111 +1,345 @@
-from util import callrpc
-from binascii import unhexlify
+from util import callrpc, rpcPriority, PRIORITY_BACKGROUND
 import json, time
 import random
 import asyncio
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import os
 
-from database import AsyncLvldb
+from database import (AsyncLvldb, INDEX_VERSION, INDEX_PREFIXES, txAddresses, addrTxKey,
+                      addrCountKey, outputKey, rewardKey, undoKey, txBodyKey, blockHashKey,
+                      blockKey, blockSummary)
+from enrich import Enricher, REWARD_PREFETCH_CHUNK, isCoinStake
 
 PORT = 51725
 
+# The standalone pre-cacher only caches blocks with at least this many
+# confirmations. The server indexes right up to the tip instead and relies
+# on undo records to roll back blocks that are reorged out.
+MIN_CONFIRMATIONS = 100
+
+# Blocks this close to the tip keep an undo record.
+UNDO_DEPTH = 100
+
+# Number of blocks fetched and enriched concurrently ahead of the block
+# currently being committed.
+PRECACHE_WINDOW = int(os.environ.get('SHELTR_PRECACHE_WINDOW', 16))
+
+# Number of consecutive blocks committed together in one LevelDB write
+# batch. Larger groups speed up the initial sync at the cost of redoing
+# up to a group of blocks after a crash.
+PRECACHE_GROUP_COMMIT = int(os.environ.get('SHELTR_PRECACHE_GROUP_COMMIT', 1))
+
+# With more than one worker the height range is fetched and enriched by
+# that many processes, each taking PRECACHE_WORKER_CHUNK blocks at a time,
+# while this process writes their results in height order.
+PRECACHE_WORKERS = int(os.environ.get('SHELTR_PRECACHE_WORKERS', 1))
+PRECACHE_WORKER_CHUNK = int(os.environ.get('SHELTR_PRECACHE_WORKER_CHUNK', 50))
+
+
+class ReorgDetected(Exception):
+    pass
 
 
 class PreCache:
-    def __init__(self, lvldb):
+    def __init__(self, lvldb, window=PRECACHE_WINDOW, groupCommit=PRECACHE_GROUP_COMMIT,
+                 workers=PRECACHE_WORKERS, workerChunk=PRECACHE_WORKER_CHUNK,
+                 minConfirmations=MIN_CONFIRMATIONS):
+        # lvldb is None inside worker processes, which cannot open the
+        # database and resolve everything over RPC instead.
         self.lvldb = lvldb
+        self.enricher = Enricher(lvldb, PORT)
+        self.window = max(1, window)
+        self.groupCommit = max(1, groupCommit)
+        self.workers = max(1, workers)
+        self.workerChunk = max(1, workerChunk)
+        self.minConfirmations = max(1, minConfirmations)
+        # Hash of the last block committed, checked against the next block's
+        # previousblockhash to notice a reorg while catching up.
+        self.lastHash = None
+        # Address tx counts changed by blocks in the batch being built.
+        self.addrCounts = {}
+        self.newBlock = asyncio.Event()
+
+    async def fetchBlock(self, height):
+        blockHash = await callrpc(PORT, "getblockhash", [height])
+
+        block = await callrpc(PORT, "getblock", [blockHash, 2])
+
+        txs = []
+        for pos, tx in enumerate(block['tx']):
+            # Already cached txs are reused as they are, so their enriched
+            # inputs are still available for the address index.
+            cached = await self.lvldb.getValue(bytes(tx['txid'], 'utf-8')) if self.lvldb else None
+            if cached:
+                block['tx'][pos] = cached
+                continue
+            txs.append(tx)
+
+        prevOuts = await self.enricher.getPrevOutputs([vin for tx in txs for vin in tx['vin']])
+
+        # The reward is kept on the block so commitBlock can persist it in the
+        # same batch, and roll it back with the block.
+        rewardDetails = None
+        if any(isCoinStake(tx) for tx in block['tx']):
+            rewardDetails = await self.enricher.getBlockReward(block['height'])
+            block['rewardDetails'] = rewardDetails
+
+        for tx in txs:
+            await self.enricher.enrichCoinStake(tx, block['height'], rewardDetails)
+
+            tx["blockhash"] = block['hash']
+            tx["height"] = block['height']
+            tx["confirmations"] = block['confirmations']
+            tx["time"] = block['time']
+            tx["blocktime"] = block['time']
+
+            tx['vin'] = await self.enricher.getInputDetails(tx['vin'], prevOuts)
+
+        return block, txs
+
+    async def getAddrCount(self, addr):
+        if addr not in self.addrCounts:
+            count = await self.lvldb.get(addrCountKey(addr))
+            self.addrCounts[addr] = int(count) if count else 0
+        return self.addrCounts[addr]
+
+    async def commitBlock(self, batch, height, block, txs):
+        if self.lastHash and block['previousblockhash'] != self.lastHash:
+            raise ReorgDetected(f"Block {height} does not extend {self.lastHash}")
+
+        undoTxs = []
+        # Count changes only reach self.addrCounts once nothing in the block
+        # can fail any more, so a failed block leaves them untouched.
+        counts = {}
+
+        # Outputs and addresses are indexed for every tx in the block,
+        # including txs cached before the indexes existed.
+        for pos, tx in enumerate(block['tx']):
+            batch.putOutputs(tx)
+            addrs = txAddresses(tx)
+            for addr in addrs:
+                batch.put(addrTxKey(addr, height, pos, tx['txid']), b'')
+                counts[addr] = (counts[addr] if addr in counts else await self.getAddrCount(addr)) + 1
+            undoTxs.append([tx['txid'], len(tx['vout']), addrs])
+
+        for tx in txs:
+            batch.putValue(bytes(tx['txid'], 'utf-8'), tx)
+
+        if 'rewardDetails' in block:
+            batch.putValue(rewardKey(height), block['rewardDetails'])
 
-    async def getInputDetails(self, inputs, txid):
-
-        for vin in inputs:
-            addr = None
-            amount = None
-            amountSats = None
-            
-            if "type" in vin and vin['type'] in ['anon', 'blind']:
-                vin['type'] = vin['type']
-                vin['addr'] = addr
-                vin['value'] = amount
-                vin['valueSat'] = amountSats
-            else:
-                inTX = await self.lvldb.get(bytes(vin['txid'], "utf-8"))
-                if not inTX:
-                    inTX = await callrpc(PORT, "getrawtransaction", [vin['txid'], True])
-                else:
-                    inTX = json.loads(inTX)
-                txType = inTX['vout'][vin['vout']]['type'] if "type" in inTX['vout'][vin['vout']] else "standard"
-
-                if txType not in ['anon', 'blind']:
-                    addr = inTX['vout'][vin['vout']]['scriptPubKey']['addresses'][0]
-                    amount = inTX['vout'][vin['vout']]['value']
-                    amountSats = inTX['vout'][vin['vout']]['valueSat']
-                
-                vin['type'] = txType
-                vin['addr'] = addr
-                vin['value'] = amount
-                vin['valueSat'] = amountSats
-
-        return inputs
+        batch.put(blockHashKey(height), bytes(block['hash'], 'utf-8'))
+        batch.putValue(blockKey(block['hash']), blockSummary(block))
 
+        if block['confirmations'] <= UNDO_DEPTH:
+            batch.putValue(undoKey(height), {
+                "hash": block['hash'],
+                "txs": undoTxs,
+            })
+        if height > UNDO_DEPTH:
+            batch.delete(undoKey(height - UNDO_DEPTH))
+
+        # bestBlock is the next height to process: everything below it is
+        # done. It is written in the same batch as the block's txs so the
+        # two can never disagree.
+        batch.put(b"bestBlock", bytes(str(height + 1), 'utf-8'))
+        self.addrCounts.update(counts)
+        self.lastHash = block['hash']
+
+    async def rollbackBlock(self, height, undo):
+        batch = self.lvldb.writeBatch()
+        counts = {}
+        for pos, (txid, voutCount, addrs) in enumerate(undo['txs']):
+            batch.delete(bytes(txid, 'utf-8'))
+            batch.delete(txBodyKey(txid))
+            for n in range(voutCount):
+                batch.delete(outputKey(txid, n))
+            for addr in addrs:
+                batch.delete(addrTxKey(addr, height, pos, txid))
+                counts[addr] = (counts[addr] if addr in counts else await self.getAddrCount(addr)) - 1
+
+        batch.delete(rewardKey(height))
+        batch.delete(blockHashKey(height))
+        batch.delete(blockKey(undo['hash']))
+        batch.delete(undoKey(height))
+        batch.put(b"bestBlock", bytes(str(height), 'utf-8'))
+        self.addrCounts.update(counts)
+        await self.writeBatch(batch)
+        print(f"Rolled back block {height} {undo['hash']}")
+
+    async def rollbackReorged(self):
+        # Walk down from the last indexed block until its stored hash matches
+        # the active chain again, undoing every block that was reorged out.
+        bestBlock = await self.lvldb.get(b"bestBlock")
+        height = int(bestBlock) - 1 if bestBlock else 0
+        while height > 0:
+            undo = await self.lvldb.getValue(undoKey(height))
+            if undo is None:
+                break
+            try:
+                chainHash = await callrpc(PORT, "getblockhash", [height])
+            except ValueError:
+                chainHash = None
+            if chainHash == undo['hash']:
+                return undo['hash']
+            await self.rollbackBlock(height, undo)
+            height -= 1
+        return None
+
+    async def writeBatch(self, batch):
+        for addr, count in self.addrCounts.items():
+            batch.put(addrCountKey(addr), bytes(str(count), 'utf-8'))
+        await batch.write()
+        self.addrCounts = {}
 
     async def itterBlocks(self):
 
         bestBlock = await self.lvldb.get(b"bestBlock")
+        batch = self.lvldb.writeBatch()
+
+        indexVersion = await self.lvldb.get(b"indexVersion")
+        if indexVersion is None or int(indexVersion) < INDEX_VERSION:
+            print("LevelDB indexes are out of date, re-walking the chain to build them.")
+            for prefix in INDEX_PREFIXES:
+                await self.lvldb.deletePrefix(prefix)
+            bestBlock = None
+            batch.put(b"indexVersion", bytes(str(INDEX_VERSION), 'utf-8'))
+            batch.put(b"bestBlock", b"1")
+            self.lastHash = None
+        else:
+            self.lastHash = await self.rollbackReorged()
+            bestBlock = await self.lvldb.get(b"bestBlock")
+
         currHeight = await callrpc(PORT, "getblockcount") + 1
+        endHeight = currHeight - self.minConfirmations + 1
+
+        if self.workers > 1:
+            blocks = self.fetchBlocksParallel(int(bestBlock) if bestBlock else 1, endHeight)
+        else:
+            blocks = self.fetchBlocks(int(bestBlock) if bestBlock else 1, endHeight)
         start = time.time()
-        
-        for i in range(int(bestBlock) if bestBlock else 1, currHeight):
-            
-            blockHash = await callrpc(PORT, "getblockhash", [i])
-
-            block = await callrpc(PORT, "getblock", [blockHash, 2])
-            
-
-            for tx in block['tx']:
-                if await self.lvldb.get(bytes(tx['txid'], 'utf-8')):
-                    continue
-
-                isCoinStake = True if unhexlify(tx['hex'])[1] == 0x02 else False
-                tx['isCoinStake'] = isCoinStake
-                if isCoinStake:
-                    rewardDetails = await callrpc(PORT, "getblockreward", [int(block['height'])])
-
-                    tx['reward'] = float(rewardDetails['blockreward'])
-                    tx['rewardSat'] = convertToSat(rewardDetails['blockreward'])
-
-                    if "gvrreward" in rewardDetails and rewardDetails['blockreward'] > 0:
-                        tx['isAGVR'] = True
-                        tx['rewardAGVR'] = float(rewardDetails['gvrreward'])
-                        tx['rewardAGVRSat'] = convertToSat(rewardDetails['gvrreward'])
-                    else:
-                        tx['isAGVR'] = False
-                
-                tx["blockhash"] = block['hash']
-                tx["height"] = block['height']
-                tx["confirmations"] = block['confirmations']
-                tx["time"] = block['time']
-                tx["blocktime"] = block['time']
-
-                tx['vin'] = await self.getInputDetails(tx['vin'], tx['txid'])
-
-                if block['confirmations'] >= 100:
-                    await self.lvldb.put(bytes(tx['txid'], 'utf-8'), json.dumps(tx, indent=2).encode('utf-8'))
-            
-            if (i % 1_000) == 0:
-                print(f"{i} Blocks processed in {time.time() - start} seconds")
-                start = time.time()
-            await self.lvldb.put(b"bestBlock", bytes(str(i), 'utf-8'))
-
-def convertFromSat(value):
-        sat_readable = value / 10**8
-        return sat_readable
-
-def convertToSat(value):
-    sat_readable = value * 10**8
-    return round(sat_readable)
+        blockCount = 0
+        txCount = 0
+        batchBlocks = 0
+
+        try:
+            async for i, block, txs in blocks:
+                # Each block is staged on its own and only joins the group
+                # batch once all of it has been committed.
+                blockBatch = self.lvldb.writeBatch()
+                await self.commitBlock(blockBatch, i, block, txs)
+                batch.extend(blockBatch)
+                batchBlocks += 1
+                if batchBlocks >= self.groupCommit:
+                    await self.writeBatch(batch)
+                    batchBlocks = 0
+
+                blockCount += 1
+                txCount += len(block['tx'])
+                if (i % 1_000) == 0:
+                    elapsed = max(time.time() - start, 1e-6)
+                    print(f"{i} Blocks processed in {elapsed:.2f} seconds, "
+                          f"{blockCount / elapsed:.1f} blocks/s, {txCount / elapsed:.1f} tx/s")
+                    start = time.time()
+                    blockCount = 0
+                    txCount = 0
+        finally:
+            await blocks.aclose()
+            # Only whole blocks are ever added to the batch, so whatever is
+            # still buffered can be written.
+            await self.writeBatch(batch)
+
+    async def fetchBlocks(self, startHeight, endHeight):
+        # Blocks are fetched and enriched concurrently within the window, but
+        # yielded strictly in height order.
+        pending = collections.deque()
+        nextHeight = startHeight
+        self.enricher.clearPrefetched()
+        try:
+            while pending or nextHeight < endHeight:
+                while nextHeight < endHeight and len(pending) < self.window:
+                    # Every block has one coinstake, so rewards are fetched in
+                    # bulk ahead of the blocks that need them.
+                    if (nextHeight - startHeight) % REWARD_PREFETCH_CHUNK == 0:
+                        self.enricher.prefetchRewards(range(nextHeight, min(nextHeight + REWARD_PREFETCH_CHUNK, endHeight)))
+                    pending.append((nextHeight, asyncio.ensure_future(self.fetchBlock(nextHeight))))
+                    nextHeight += 1
+
+                height, task = pending.popleft()
+                block, txs = await task
+                yield height, block, txs
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def fetchRange(self, startHeight, endHeight):
+        return [result async for result in self.fetchBlocks(startHeight, endHeight)]
+
+    async def fetchBlocksParallel(self, startHeight, endHeight):
+        # Chunks of the range go to the worker processes in height order and
+        # are yielded in the same order, so bestBlock only ever advances over
+        # a fully completed prefix.
+        loop = asyncio.get_running_loop()
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn"))
+        pending = collections.deque()
+        nextHeight = startHeight
+        try:
+            while pending or nextHeight < endHeight:
+                while nextHeight < endHeight and len(pending) < self.workers * 2:
+                    rangeEnd = min(nextHeight + self.workerChunk, endHeight)
+                    pending.append(loop.run_in_executor(pool, fetchRangeWorker, nextHeight, rangeEnd, self.window))
+                    nextHeight = rangeEnd
+
+                for result in await pending.popleft():
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def notify(self):
+        self.newBlock.set()
+
+    async def follow(self):
+        # Keeps the cache and indexes up to date inside the server, catching
+        # up whenever a new block is announced.
+        rpcPriority.set(PRIORITY_BACKGROUND)
+        while True:
+            try:
+                await self.itterBlocks()
+            except ReorgDetected as e:
+                print(f"Reorg detected: {e}")
+                continue
+            except Exception as e:
+                print(f"Pre-cache error: {e}")
+            await self.newBlock.wait()
+            self.newBlock.clear()
+
+def fetchRangeWorker(startHeight, endHeight, window):
+    rpcPriority.set(PRIORITY_BACKGROUND)
+    return asyncio.run(PreCache(None, window=window).fetchRange(startHeight, endHeight))
+
 
 async def main():
+    parser = argparse.ArgumentParser(description="Pre-cache confirmed transactions into LevelDB.")
+    parser.add_argument("--window", type=int, default=PRECACHE_WINDOW,
+                        help="number of blocks fetched concurrently (default: %(default)s)")
+    parser.add_argument("--group-commit", type=int, default=PRECACHE_GROUP_COMMIT,
+                        help="number of blocks written per LevelDB batch (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=PRECACHE_WORKERS,
+                        help="number of processes fetching and enriching blocks (default: %(default)s)")
+    parser.add_argument("--worker-chunk", type=int, default=PRECACHE_WORKER_CHUNK,
+                        help="number of blocks handed to a worker at a time (default: %(default)s)")
+    args = parser.parse_args()
+
+    rpcPriority.set(PRIORITY_BACKGROUND)
     lvldb = AsyncLvldb()
-    pre_cache = PreCache(lvldb)
+    pre_cache = PreCache(lvldb, window=args.window, groupCommit=args.group_commit,
+                         workers=args.workers, workerChunk=args.worker_chunk)
     await pre_cache.itterBlocks()
     
 if __name__ == '__main__':
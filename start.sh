@@ -7,6 +7,9 @@ SSL_KEYFILE=""
 SSL_CERTFILE=""
 PRODUCTION="false"
 STOP_SERVER="false"
+RPC_POOL_SIZE="8"
+RPC_TIMEOUT="120"
+CACHE_SIZE="64"
 
 # Parse arguments
 while [[ $# -gt 0 ]]; do
@@ -27,6 +30,18 @@ while [[ $# -gt 0 ]]; do
             SSL_CERTFILE="${1#*=}"
             shift
             ;;
+        --rpc-pool-size=*)
+            RPC_POOL_SIZE="${1#*=}"
+            shift
+            ;;
+        --rpc-timeout=*)
+            RPC_TIMEOUT="${1#*=}"
+            shift
+            ;;
+        --cache-size=*)
+            CACHE_SIZE="${1#*=}"
+            shift
+            ;;
         --production)
             PRODUCTION="true"
             shift
@@ -47,6 +62,10 @@ if [[ $PRODUCTION == "true" ]]; then
     HOST="0.0.0.0"
 fi
 
+export SHELTR_RPC_POOL_SIZE="$RPC_POOL_SIZE"
+export SHELTR_RPC_TIMEOUT="$RPC_TIMEOUT"
+export SHELTR_TX_CACHE_MB="$CACHE_SIZE"
+
 # Stop the server if the --stop flag is provided
 if [[ $STOP_SERVER == "true" ]]; then
     kill $(lsof -t -i:$PORT)
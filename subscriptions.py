@@ -0,0 +1,64 @@
+import os
+
+# Addresses a single Socket.IO session can watch at once.
+SUBSCRIBE_MAX_ADDRS = int(os.environ.get('SHELTR_SUBSCRIBE_MAX_ADDRS', 1000))
+
+
+def parseAddresses(addrs):
+    """Accept a list or a comma separated string of addresses."""
+    if isinstance(addrs, str):
+        addrs = addrs.split(",")
+    return [addr for addr in addrs if isinstance(addr, str) and addr]
+
+
+class AddressSubscriptions:
+    """Which Socket.IO sessions watch which addresses, indexed both ways so
+    routing a tx and dropping a disconnected session are both cheap.
+    """
+    def __init__(self):
+        # address -> set of sids, and sid -> set of addresses.
+        self.addrSids = {}
+        self.sidAddrs = {}
+
+    def subscribe(self, sid, addrs):
+        """Watch addrs for sid, up to SUBSCRIBE_MAX_ADDRS; returns how many it watches."""
+        watched = self.sidAddrs.setdefault(sid, set())
+        for addr in addrs:
+            if addr in watched:
+                continue
+            if len(watched) >= SUBSCRIBE_MAX_ADDRS:
+                break
+            watched.add(addr)
+            self.addrSids.setdefault(addr, set()).add(sid)
+        if not watched:
+            del self.sidAddrs[sid]
+        return len(watched)
+
+    def unsubscribe(self, sid, addrs=None):
+        """Stop watching addrs for sid, or every address when addrs is None."""
+        watched = self.sidAddrs.get(sid)
+        if watched is None:
+            return 0
+        for addr in list(watched) if addrs is None else addrs:
+            if addr not in watched:
+                continue
+            watched.discard(addr)
+            sids = self.addrSids[addr]
+            sids.discard(sid)
+            if not sids:
+                del self.addrSids[addr]
+        if not watched:
+            del self.sidAddrs[sid]
+        return len(watched)
+
+    def sessions(self, addrs):
+        sids = set()
+        for addr in addrs:
+            sids.update(self.addrSids.get(addr, ()))
+        return sids
+
+    def stats(self):
+        return {
+            "sessions": len(self.sidAddrs),
+            "addresses": len(self.addrSids),
+        }
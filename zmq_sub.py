@@ -23,9 +23,11 @@
     https://github.com/bitcoin/bitcoin/blob/37a7fe9e440b83e2364d5498931253937abe9294/contrib/zmq/zmq_sub.py
 """
 
-import binascii
 import asyncio
+import itertools
+import os
 import time
+from collections import OrderedDict
 
 import zmq
 import zmq.asyncio
@@ -35,7 +37,10 @@ import sys
 import json
 import socketio
 
-from util import callrpc
+from util import callrpc, rpcPriority, TipCache, PRIORITY_TIP
+from enrich import Enricher
+from emitter import Emitter
+from decoder import decodeTx, decodeBlock, isCoinStakeRaw, txSummary, DecodeError
 
 if (sys.version_info.major, sys.version_info.minor) < (3, 5):
     print("This example only works with Python 3.5 and greater")
@@ -43,14 +48,40 @@ if (sys.version_info.major, sys.version_info.minor) < (3, 5):
 
 port = 28332
 
+# Messages ghostd may have queued for us before ZMQ starts dropping them.
+# Dropped messages show up as sequence gaps, after which the mempool
+# mirror resyncs.
+ZMQ_RCVHWM = int(os.environ.get('SHELTR_ZMQ_RCVHWM', 10000))
+
+# Received messages waiting for a processing worker. When the queue is full
+# new rawtx messages are dropped; block notifications are always queued.
+ZMQ_QUEUE_SIZE = int(os.environ.get('SHELTR_ZMQ_QUEUE_SIZE', 1000))
+ZMQ_WORKERS = int(os.environ.get('SHELTR_ZMQ_WORKERS', 4))
+
+# Queue priority by topic, lowest first.
+TOPIC_PRIORITY = {b"hashblock": 0, b"rawblock": 0, b"rawtx": 1}
+
+# rawtx messages decoded both locally and by ghostd before the local decoder
+# is trusted on its own. Any difference switches back to decoderawtransaction.
+DECODER_CHECKS = int(os.environ.get('SHELTR_DECODER_CHECKS', 20))
+
+# Mempool txs already sent to the tx room, so the rawtx ghostd sends again
+# when they are mined is not sent twice. Entries leave when the tx is mined
+# or evicted, or at the latest after SENT_TX_TTL seconds. Mined txs are kept
+# for MINED_TX_GRACE more seconds, as their rawtx can still be queued behind
+# the block.
+SENT_TX_TTL = int(os.environ.get('SHELTR_SENT_TX_TTL', 86400))
+SENT_TX_MAX = int(os.environ.get('SHELTR_SENT_TX_MAX', 100000))
+MINED_TX_GRACE = int(os.environ.get('SHELTR_MINED_TX_GRACE', 600))
+
 
 class ZMQHandler():
-    def __init__(self, rpcPort, loop, app):
+    def __init__(self, rpcPort, loop, app, lvldb=None, onBlock=None, tip=None, mempool=None, subscriptions=None, emitter=None):
         self.loop = loop
         self.zmqContext = zmq.asyncio.Context()
 
         self.zmqSubSocket = self.zmqContext.socket(zmq.SUB)
-        self.zmqSubSocket.setsockopt(zmq.RCVHWM, 0)
+        self.zmqSubSocket.setsockopt(zmq.RCVHWM, ZMQ_RCVHWM)
         self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "hashblock")
         self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "hashtx")
         self.zmqSubSocket.setsockopt_string(zmq.SUBSCRIBE, "rawblock")
@@ -59,42 +90,154 @@ class ZMQHandler():
         self.zmqSubSocket.connect("tcp://127.0.0.1:%i" % port)
         self.rpcPort = rpcPort
         self.app = app
+        self.emitter = emitter if emitter is not None else Emitter(app._sio)
+        self.lvldb = lvldb
+        self.enricher = Enricher(lvldb, rpcPort)
+        self.onBlock = onBlock
+        self.tip = tip if tip is not None else TipCache(rpcPort)
+        self.mempool = mempool
+        self.subscriptions = subscriptions
+
+        # txid -> time it was sent or mined, oldest first.
+        self.sentTxInfo = OrderedDict()
+        self.minedTxids = OrderedDict()
+
+        self.localDecode = True
+        self.decoderChecks = DECODER_CHECKS
+
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.tasks = []
+        # Per topic: last sequence number received and last one a worker
+        # started on, messages missed according to the sequence numbers,
+        # and messages dropped because the queue was full.
+        self.lastReceived = {}
+        self.lastProcessed = {}
+        self.missed = {}
+        self.dropped = {}
+        self.maxWait = 0.0
+
+    async def receive(self):
+        while True:
+            try:
+                topic, body, seq = await self.zmqSubSocket.recv_multipart()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ZMQ receive error: {e}")
+                await asyncio.sleep(1)
+                continue
 
-        self.sentTxInfo = []
+            sequence = None
+            if len(seq) == 4:
+                sequence = struct.unpack('<I', seq)[-1]
+                last = self.lastReceived.get(topic)
+                if last is not None and sequence != (last + 1) & 0xFFFFFFFF:
+                    self.missed[topic] = self.missed.get(topic, 0) + ((sequence - last - 1) & 0xFFFFFFFF)
+                self.lastReceived[topic] = sequence
+
+            # Cheap topics are handled right here, in the order they arrive.
+            if topic == b"rawblock" and self.onBlock:
+                self.onBlock()
+            if topic == b"sequence":
+                if self.mempool and sequence is not None:
+                    self.mempool.onSequence(body, sequence)
+                if body[32:33] == b"R":
+                    self.sentTxInfo.pop(body[:32].hex(), None)
+            elif topic in TOPIC_PRIORITY:
+                if topic == b"rawtx" and self.queue.qsize() >= ZMQ_QUEUE_SIZE:
+                    self.dropped[topic] = self.dropped.get(topic, 0) + 1
+                    continue
+                self.queue.put_nowait((TOPIC_PRIORITY[topic], next(self.order), topic, body, sequence, time.monotonic()))
 
-    async def handle(self):
-        topic, body, seq = await self.zmqSubSocket.recv_multipart()
-        sequence = "Unknown"
-        if len(seq) == 4:
-            sequence = str(struct.unpack('<I', seq)[-1])
+    async def work(self):
+        rpcPriority.set(PRIORITY_TIP)
+        while True:
+            _, _, topic, body, sequence, received = await self.queue.get()
+            self.maxWait = max(self.maxWait, time.monotonic() - received)
+            if sequence is not None:
+                self.lastProcessed[topic] = sequence
+            if self.queue.empty():
+                # Whatever was received since and is not queued was dropped,
+                # so nothing is left behind.
+                for queuedTopic in TOPIC_PRIORITY:
+                    if queuedTopic in self.lastReceived:
+                        self.lastProcessed[queuedTopic] = self.lastReceived[queuedTopic]
+            await self.handle(topic, body)
+
+    async def handle(self, topic, body):
         if topic == b"hashblock":
+            if self.onBlock:
+                self.onBlock()
             try:
-                bc_info = await callrpc(self.rpcPort, "getblockchaininfo", [])
-                await self.app.emit('room_message', bc_info, room="block")
+                await self.tip.refresh()
+                bc_info = self.tip.chainInfo
+                await self.emitter.emit('room_message', bc_info, room="block", latest=True)
             except Exception as e:
                 print(e)
 
-        elif topic == b"hashtx":
-            pass
+            # Without rawblock notifications the mined txs come from getblock.
+            if b"rawblock" not in self.lastReceived:
+                try:
+                    block = await callrpc(self.rpcPort, "getblock", [body.hex(), 1])
+                    self.txsMined(block['tx'])
+                except Exception as e:
+                    print(e)
+
         elif topic == b"rawblock":
-            pass
+            try:
+                self.txsMined(decodeBlock(body, txDetails=False)['tx'])
+            except DecodeError as e:
+                print(f"Local block decode failed: {e}")
+
         elif topic == b"rawtx":
             try:
-                await self.processTx(binascii.hexlify(body).decode("utf-8"), body[1] == 0x02)
+                await self.processTx(body, isCoinStakeRaw(body))
             except Exception as e:
                 print(e)
 
-        # schedule ourselves to receive the next message
-        asyncio.ensure_future(self.handle())
+    async def decodeRawTx(self, body):
+        if not self.localDecode:
+            return await callrpc(self.rpcPort, "decoderawtransaction", [body.hex()])
+        try:
+            tx = decodeTx(body)
+        except DecodeError as e:
+            print(f"Local decode failed: {e}")
+            return await callrpc(self.rpcPort, "decoderawtransaction", [body.hex()])
+
+        if self.decoderChecks > 0:
+            self.decoderChecks -= 1
+            rpcTx = await callrpc(self.rpcPort, "decoderawtransaction", [body.hex()])
+            if txSummary(tx) != txSummary(rpcTx):
+                print(f"Local decode of {rpcTx['txid']} differs from ghostd, using decoderawtransaction")
+                self.localDecode = False
+                return rpcTx
+        return tx
+
+    async def processTx(self, body, isCoinStake):
+        decodeTx = await self.decodeRawTx(body)
+        txid = decodeTx['txid']
+
+        # Sent before, this is the copy ghostd sends when the tx is mined.
+        if self.sentTxInfo.pop(txid, None) is not None \
+                or self.minedTxids.pop(txid, None) is not None:
+            return
 
-    async def processTx(self, rawTx, isCoinStake):
-        decodeTx = await callrpc(self.rpcPort, "decoderawtransaction", [rawTx])
-        
-        if decodeTx['txid'] in self.sentTxInfo:
-            self.sentTxInfo.remove(decodeTx['txid'])
-            
+        if isCoinStake:
+            await self.sendTx(decodeTx, isCoinStake)
             return
-        
+
+        # Claimed before the first await, so another worker handling a copy
+        # of the same tx takes it as sent.
+        self.sentTxInfo[txid] = time.monotonic()
+        try:
+            await self.sendTx(decodeTx, isCoinStake)
+        except BaseException:
+            self.sentTxInfo.pop(txid, None)
+            raise
+        self.expireSentTxs()
+
+    async def sendTx(self, decodeTx, isCoinStake):
         inputs = await self.getInputs(decodeTx['vin'])
         outputs = {
             "addrs": {},
@@ -129,10 +272,27 @@ class ZMQHandler():
             "isCoinStake": isCoinStake
         }
 
-        await self.app.emit('room_message', txInfo, room="tx")
+        await self.emitter.emit('room_message', txInfo, room="tx")
+
+        if self.subscriptions:
+            addrs = (set(txInfo['inputs']) | set(txInfo['outputs'])) - {"anon"}
+            for sid in self.subscriptions.sessions(addrs):
+                # Sessions in the tx room already have it.
+                if "tx" not in self.emitter.rooms(sid):
+                    await self.emitter.emit('room_message', txInfo, to=sid)
+
+    def txsMined(self, txids):
+        now = time.monotonic()
+        for txid in txids:
+            if self.sentTxInfo.pop(txid, None) is not None:
+                self.minedTxids[txid] = now
+        self.expireSentTxs()
 
-        if not isCoinStake:
-            self.sentTxInfo.append(decodeTx['txid'])
+    def expireSentTxs(self):
+        now = time.monotonic()
+        for txids, ttl in ((self.sentTxInfo, SENT_TX_TTL), (self.minedTxids, MINED_TX_GRACE)):
+            while txids and (len(txids) > SENT_TX_MAX or next(iter(txids.values())) < now - ttl):
+                txids.popitem(last=False)
 
     async def getInputs(self, vin):
         inputs = {
@@ -140,6 +300,8 @@ class ZMQHandler():
             "inputAmount": 0
         }
 
+        prevOuts = await self.enricher.getPrevOutputs(vin)
+
         for txIn in vin:
             if "type" in txIn and txIn['type'] in ["blind", "anon"]:
                 if "anon" in inputs['addrs']:
@@ -147,43 +309,53 @@ class ZMQHandler():
                 else:
                     inputs['addrs']['anon'] = 0
                     continue
-            utxo = await callrpc(self.rpcPort, "getrawtransaction", [txIn['txid'], True])
-            utxo = utxo["vout"][txIn['vout']]
 
-            addr = utxo['scriptPubKey']['addresses'][0]
+            utxo = prevOuts[(txIn['txid'], txIn['vout'])]
+            addr = utxo['addr']
 
             if addr in inputs['addrs']:
-                if "value" in utxo:
+                if utxo['value'] is not None:
                     inputs['addrs'][addr] += utxo['value']
                     inputs['inputAmount'] += utxo['value']
             else:
-                if "value" in utxo:
+                if utxo['value'] is not None:
                     inputs['addrs'][addr] = utxo['value']
                     inputs['inputAmount'] += utxo['value']
 
         return inputs
 
     async def cleanUpTxid(self):
-
+        # Mined and evicted txs are dropped as the events come in; this only
+        # expires what was missed, e.g. while ghostd restarted.
         while True:
-
-            for txid in self.sentTxInfo.copy():
-                
-                try:
-                    tx = await callrpc(self.rpcPort, "getrawtransaction", [txid, True])
-
-                    if "confirmations" in tx and (tx['confirmations'] < 0 or tx['confirmations'] > 0):
-                        self.sentTxInfo.remove(txid)
-                except:
-                    self.sentTxInfo.remove(txid)
-                    
-            await asyncio.sleep(600)
+            self.expireSentTxs()
+            await asyncio.sleep(60)
+
+    def stats(self):
+        lag = {}
+        for topic, last in self.lastReceived.items():
+            if topic in self.lastProcessed:
+                lag[topic.decode()] = (last - self.lastProcessed[topic]) & 0xFFFFFFFF
+        return {
+            "queued": self.queue.qsize(),
+            "maxWait": self.maxWait,
+            "lag": lag,
+            "missed": {topic.decode(): n for topic, n in self.missed.items()},
+            "dropped": {topic.decode(): n for topic, n in self.dropped.items()},
+            "localDecode": self.localDecode,
+            "sentTxs": len(self.sentTxInfo),
+            "minedTxs": len(self.minedTxids),
+        }
 
     def start(self):
-        self.loop.create_task(self.handle())
-        self.loop.create_task(self.cleanUpTxid())
+        self.tasks.append(self.loop.create_task(self.receive()))
+        for _ in range(max(1, ZMQ_WORKERS)):
+            self.tasks.append(self.loop.create_task(self.work()))
+        self.tasks.append(self.loop.create_task(self.cleanUpTxid()))
 
     def stop(self):
+        for task in self.tasks:
+            task.cancel()
         self.loop.stop()
         self.zmqContext.destroy()
 